@@ -0,0 +1,85 @@
+"""
+This file is part of foitorrent.
+Copyright (c) 2013  Brendan Molloy
+
+foitorrent is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+foitorrent is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with foitorrent.  If not, see <http://www.gnu.org/licenses/>.
+
+Synthetic disclosure log pages shaped like the ones each scraper reads,
+padded with navigation and footer markup so parse costs are realistic.
+All pages are UTF-8 bytes with non-breaking spaces, as served.
+"""
+
+import datetime
+
+PADDING = "".join('<li class="nav-item"><a href="/section/%d">Section&nbsp;%d</a></li>' % (n, n)
+                  for n in range(200))
+
+page_template = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{title}</title></head>
+<body><div id="header"><ul class="nav">{padding}</ul></div>
+{content}
+<div id="footer"><ul class="nav">{padding}</ul></div></body></html>
+"""
+
+
+def page(title, content):
+    return page_template.format(title=title, content=content, padding=PADDING).encode('utf-8')
+
+
+def release_date(n):
+    return datetime.datetime(2013, 1, 1) + datetime.timedelta(days=n % 365)
+
+
+def agd_listing(base, start, count, next_page=None):
+    items = "".join("""<div class="dl-item"><div class="dl-item-title">
+<a title="FOI request {n}" href="{base}/foi/log/{n}">FOI&nbsp;request {n}</a></div></div>
+""".format(n=n, base=base) for n in range(start, start + count))
+    paging = "" if next_page is None else \
+        '<div class="paging-next"><a href="%s">Next</a></div>' % next_page
+    return page("Disclosure log", '<div class="disclosure-log-list">%s</div>%s' % (items, paging))
+
+
+def agd_detail(base, n, docs):
+    downloads = "".join('<a href="/docs/%d/document_%d.pdf">Document&nbsp;%d</a>' % (n, d, d)
+                        for d in range(docs))
+    return page("FOI request %d" % n, """<div class="wc-title"><h1>FOI request {n}</h1></div>
+<div class="dl-date"><span class="dl-value">{date}</span></div>
+<div class="dl-abstract"><span class="dl-value">Documents relating to&nbsp;matter {n}.</span></div>
+<div class="dl-downloads">{downloads}</div>""".format(
+        n=n, date=release_date(n).strftime("%A, %d %B %Y"), downloads=downloads))
+
+
+def dfat_log(rows, docs):
+    body = "".join("""<tr><td>FOI{n:05d}</td><td>{date}</td>
+<td><p>Documents relating to&nbsp;matter {n}.</p></td><td>{anchors}</td><td>Released</td></tr>
+""".format(n=n, date=release_date(n).strftime("%d %B %Y"),
+           anchors="".join('<a href="/foi/docs/%d/document_%d.pdf">Document %d</a>' % (n, d, d)
+                           for d in range(docs)))
+        for n in range(rows))
+    return page("Disclosure log", '<table id="requests"><tbody>%s</tbody></table>' % body)
+
+
+def defence_index(urls):
+    return page("Disclosure log", "".join('<div class="homeBtn"><a href="%s">Log</a></div>' % u
+                                          for u in urls))
+
+
+def defence_log(start, rows, docs):
+    body = "".join("""<tr><td>{date}&nbsp;(updated)</td><td>{n:03d}/12/13</td>
+<td><span class="foiTitle">FOI request {n}</span>{anchors}</td><td>Full</td><td>s47F</td></tr>
+""".format(n=n, date=release_date(n).strftime("%d-%b-%y"),
+           anchors="".join('<a href="docs/%d/document_%d.pdf">Document %d</a>' % (n, d, d)
+                           for d in range(docs)))
+        for n in range(start, start + rows))
+    return page("Disclosure log", '<table id="table"><tbody>%s</tbody></table>' % body)
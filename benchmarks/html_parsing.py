@@ -0,0 +1,99 @@
+"""
+This file is part of foitorrent.
+Copyright (c) 2013  Brendan Molloy
+
+foitorrent is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+foitorrent is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with foitorrent.  If not, see <http://www.gnu.org/licenses/>.
+
+Compares the old page handling (decode to str, regex out non-breaking
+spaces, parse, translate CSS on every query) with the parsing module
+over synthetic disclosure log pages:
+
+    python -m foitorrent.benchmarks.html_parsing --rows 500 --repeat 50
+"""
+
+import argparse
+import re
+import time
+
+import lxml.html
+
+from .. import parsing
+from . import fixtures
+
+
+def old_parse(content):
+    return lxml.html.fromstring(re.sub('Â?\u00a0', ' ', content.decode('utf-8')))
+
+
+def old_dfat(content):
+    page = old_parse(content)
+    rows = [row for row in page.cssselect("#requests tbody tr")
+            if len(row.cssselect('td')) == 5]
+    return [(row[0].text_content().strip(), [a.text_content().strip() for a in row[3].cssselect('a')])
+            for row in rows]
+
+
+def new_dfat(content):
+    page = parsing.parse(content, 'utf-8')
+    rows = [row for row in parsing.css("#requests tbody tr")(page)
+            if len(parsing.css('td')(row)) == 5]
+    return [(parsing.text(row[0]), [parsing.text(a) for a in parsing.css('a')(row[3])])
+            for row in rows]
+
+
+def old_agd(content):
+    page = old_parse(content)
+    return [a.attrib['title'].strip()
+            for a in page.cssselect(".disclosure-log-list .dl-item-title a")]
+
+
+def new_agd(content):
+    page = parsing.parse(content, 'utf-8')
+    return [parsing.attr(a, 'title')
+            for a in parsing.css(".disclosure-log-list .dl-item-title a")(page)]
+
+
+def timed(label, content, func, repeat):
+    result = func(content)
+    start = time.time()
+    for _ in range(repeat):
+        func(content)
+    elapsed = (time.time() - start) / repeat
+    print("%-28s %8.2f ms/page %8.1f MB/s" % (label, elapsed * 1000,
+                                              len(content) / elapsed / 1048576))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark disclosure log parsing.")
+    parser.add_argument('--rows', type=int, default=500, help="rows/items per page")
+    parser.add_argument('--docs', type=int, default=3, help="documents per row")
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    dfat = fixtures.dfat_log(args.rows, args.docs)
+    agd = fixtures.agd_listing("http://localhost", 0, args.rows, "http://localhost/?page=2")
+    print("DFAT log: %.1f KB, AGD listing: %.1f KB" % (len(dfat) / 1024, len(agd) / 1024))
+
+    a = timed("dfat: old", dfat, old_dfat, args.repeat)
+    b = timed("dfat: parsing", dfat, new_dfat, args.repeat)
+    assert a == b, "old and new DFAT results differ"
+
+    a = timed("agd listing: old", agd, old_agd, args.repeat)
+    b = timed("agd listing: parsing", agd, new_agd, args.repeat)
+    assert a == b, "old and new AGD results differ"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+This file is part of foitorrent.
+Copyright (c) 2013  Brendan Molloy
+
+foitorrent is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+foitorrent is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with foitorrent.  If not, see <http://www.gnu.org/licenses/>.
+
+Compares sequential, multi-process and transmission-create piece hashing
+over a synthetic request tree:
+
+    python -m foitorrent.benchmarks.piece_hashing --size 2048 --files 40
+"""
+
+import argparse
+import os
+import os.path
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+from ..torrents import TorrentBuilder
+
+
+def make_tree(path, total_mb, files):
+    os.makedirs(path, exist_ok=True)
+    rnd = random.Random(1)
+    remaining = total_mb * 1024 * 1024
+    block = os.urandom(1024 * 1024)
+    for n in range(files):
+        size = remaining if n == files - 1 else rnd.randint(1, 2 * remaining // (files - n))
+        remaining -= size
+        with open(os.path.join(path, "document_%03d.pdf" % n), 'wb') as f:
+            while size > 0:
+                f.write(block[:min(size, len(block))])
+                size -= len(block)
+
+
+def timed(label, total_mb, func):
+    start = time.time()
+    result = func()
+    elapsed = time.time() - start
+    print("%-24s %8.2fs %10.1f MB/s" % (label, elapsed, total_mb / elapsed))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark torrent piece hashing.")
+    parser.add_argument('--size', type=int, default=2048, help="total size in MB")
+    parser.add_argument('--files', type=int, default=40)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--dir', default=None, help="reuse or create the tree here")
+    args = parser.parse_args()
+
+    tmp = None
+    path = args.dir
+    if path is None:
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp, "request")
+    if not os.path.isdir(path) or len(os.listdir(path)) == 0:
+        print("Creating %d MB in %d files under %s..." % (args.size, args.files, path))
+        make_tree(path, args.size, args.files)
+
+    try:
+        sequential = TorrentBuilder(path, creation_date=0)
+        total_mb = sequential.total_size / (1024 * 1024)
+        a = timed("sequential", total_mb, sequential.hash_pieces)
+
+        parallel = TorrentBuilder(path, creation_date=0, processes=args.processes)
+        parallel.PARALLEL_THRESHOLD = 0
+        b = timed("process pool", total_mb, parallel.hash_pieces)
+        assert a == b, "parallel piece hashes differ from sequential ones"
+
+        if shutil.which('transmission-create'):
+            out = os.path.join(tmp or path, "bench.torrent")
+            timed("transmission-create", total_mb, lambda: subprocess.check_call(
+                ['transmission-create', '-o', out, path],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        else:
+            print("transmission-create not found; skipping")
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()
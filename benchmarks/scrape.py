@@ -0,0 +1,264 @@
+"""
+This file is part of foitorrent.
+Copyright (c) 2013  Brendan Molloy
+
+foitorrent is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+foitorrent is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with foitorrent.  If not, see <http://www.gnu.org/licenses/>.
+
+End-to-end Scraper.scrape benchmark that never touches the real sites.
+A local HTTP server acts as the scrapers' proxy and answers for the
+department hosts with synthetic listing and detail pages (see
+fixtures.py) and documents; torrents are built natively and handed to a
+stub client, and the database is mongomock if installed, otherwise a
+throwaway database on a local mongod:
+
+    python -m foitorrent.benchmarks.scrape --requests 2000 --docs 3 --doc-size 256
+
+Recorded pages can be replayed instead of the synthetic ones by saving
+them in a directory under their percent-encoded URL and passing --pages.
+"""
+
+import argparse
+import hashlib
+import http.server
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import pymongo
+
+from .. import departments, metrics
+from ..scraper import scrapers
+from ..torrents import BitTorrentClient
+from . import fixtures
+
+AGD_START = departments.AGD['listing']['start']
+DFAT_START = departments.DFAT['listing']['start']
+DEFENCE_START = departments.DEFENCE['listing']['start']
+
+
+class StubClient(BitTorrentClient):
+    def add_torrent(self, path, target):
+        pass
+
+    def remove_torrent(self, torrent):
+        pass
+
+    def set_trackers(self, torrent, trackers):
+        pass
+
+
+class FixtureSite:
+    """Maps the departments' URLs to generated responses."""
+
+    def __init__(self, requests, docs, doc_size, per_page, pages=None):
+        self.requests = requests
+        self.docs = docs
+        self.doc_size = doc_size
+        self.per_page = per_page
+        self.pages = pages
+        self.block = os.urandom(doc_size)
+
+    def recorded(self, url):
+        if self.pages is None:
+            return None
+        fn = os.path.join(self.pages, urllib.parse.quote(url, safe=''))
+        if not os.path.exists(fn):
+            return None
+        with open(fn, 'rb') as f:
+            return f.read()
+
+    def document(self, url):
+        # Unique per URL so the blob store has nothing to collapse.
+        prefix = hashlib.sha1(url.encode('utf-8')).digest()
+        return prefix + self.block[len(prefix):]
+
+    def agd_listing(self, page):
+        pages = (self.requests + self.per_page - 1) // self.per_page
+        start = (page - 1) * self.per_page
+        next_page = None if page >= pages else \
+            "%s?lsf=date&lso=0&page=%d" % (AGD_START, page + 1)
+        return fixtures.agd_listing("http://www.ag.gov.au", start,
+                                    min(self.per_page, self.requests - start), next_page)
+
+    def defence_logs(self):
+        return ["disclosure_log_%d.htm" % n
+                for n in range((self.requests + self.per_page - 1) // self.per_page)]
+
+    def get(self, url):
+        body = self.recorded(url)
+        if body is not None:
+            return body, "text/html; charset=utf-8"
+
+        x = urllib.parse.urlparse(url)
+        if x.path.endswith('.pdf'):
+            return self.document(url), "application/pdf"
+
+        page = None
+        if x.path == urllib.parse.urlparse(AGD_START).path:
+            query = urllib.parse.parse_qs(x.query)
+            page = self.agd_listing(int(query.get('page', ['1'])[0]))
+        elif x.netloc == "www.ag.gov.au" and x.path.startswith("/foi/log/"):
+            page = fixtures.agd_detail("http://www.ag.gov.au", int(x.path.rsplit('/', 1)[-1]),
+                                       self.docs)
+        elif url == DFAT_START:
+            page = fixtures.dfat_log(self.requests, self.docs)
+        elif url == DEFENCE_START:
+            page = fixtures.defence_index(self.defence_logs())
+        elif x.netloc == "www.defence.gov.au" and x.path.startswith("/foi/disclosure_log_"):
+            n = int(x.path.rsplit('_', 1)[-1].split('.')[0])
+            start = n * self.per_page
+            page = fixtures.defence_log(start, min(self.per_page, self.requests - start),
+                                        self.docs)
+        return page, "text/html; charset=utf-8"
+
+
+class FixtureHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; with Nagle on, every
+    # keep-alive response stalls on the client's delayed ACK.
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        # As a proxy we are sent absolute URLs.
+        body, content_type = self.server.site.get(self.path)
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_server(site):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+    server.daemon_threads = True
+    server.site = site
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def connect(mongo):
+    try:
+        import mongomock
+    except ImportError:
+        mongomock = None
+    if mongomock is not None and mongo is None:
+        return mongomock.MongoClient().foitorrent_benchmark, "mongomock"
+    client = pymongo.MongoClient(mongo or "mongodb://localhost:27017")
+    client.drop_database("foitorrent_benchmark")
+    return client.foitorrent_benchmark, "mongod"
+
+
+def run(dept, db, proxy, profile=None):
+    scraper = scrapers[dept](db=db, client=StubClient())
+    scraper.session.proxies.update({'http': proxy, 'https': proxy})
+    scraper.config['summary_path'] = None
+    if profile is not None:
+        scraper.config['profile_path'] = "%s.%s" % (profile, dept)
+
+    start = time.time()
+    found = scraper.scrape()
+    elapsed = time.time() - start
+
+    run = scraper.run_summary['metrics']
+    torrent_seconds = metrics.total(run, "torrent_create", 'sum')
+    print("%-8s %6d requests in %7.2fs: %8.2f requests/s" % (dept, found, elapsed, found / elapsed))
+    print("         listing %.2fs; %d pages fetched in %.2fs, %.2fs of it parsing" % (
+        metrics.total(run, "start_page", 'sum') + metrics.total(run, "find_new_documents", 'sum'),
+        metrics.total(run, "page_fetch", 'count'), metrics.total(run, "page_fetch", 'sum'),
+        metrics.total(run, "page_parse", 'sum')))
+    print("         %d documents, %.1f MB/s downloaded, %.2f documents/s" % (
+        metrics.total(run, "documents"), scraper.run_summary['rates']['download_mb_per_second'],
+        scraper.run_summary['rates']['documents_per_second']))
+    print("         torrents %.2fs total, %.1f ms each, %.1f MB/s" % (
+        torrent_seconds, 1000 * torrent_seconds / max(found, 1),
+        scraper.run_summary['rates']['hash_mb_per_second']))
+    return found, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Scraper.scrape offline.")
+    parser.add_argument('departments', nargs='*', help="default: all")
+    parser.add_argument('--requests', type=int, default=500, help="requests per department")
+    parser.add_argument('--docs', type=int, default=2, help="documents per request")
+    parser.add_argument('--doc-size', type=int, default=64, help="document size in KB")
+    parser.add_argument('--per-page', type=int, default=100,
+                        help="requests per AGD listing page or Defence log page")
+    parser.add_argument('--pages', default=None, help="directory of recorded pages to replay")
+    parser.add_argument('--mongo', default=None,
+                        help="MongoDB URI to use instead of mongomock")
+    parser.add_argument('--profile', default=None, metavar='FILE',
+                        help="write cProfile stats to FILE.<department>")
+    parser.add_argument('--keep', action='store_true', help="keep the working directory")
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    departments = args.departments or sorted(scrapers.keys())
+    for dept in departments:
+        if dept not in scrapers:
+            parser.error("unknown department '%s'" % dept)
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    site = FixtureSite(args.requests, args.docs, args.doc_size * 1024, args.per_page, args.pages)
+    server = start_server(site)
+    proxy = "http://127.0.0.1:%d" % server.server_port
+    db, backend = connect(args.mongo)
+
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="foitorrent-bench-")
+    os.chdir(workdir)
+    print("Working in %s, database: %s" % (workdir, backend))
+    try:
+        total_found = 0
+        total_elapsed = 0.0
+        for dept in departments:
+            found, elapsed = run(dept, db, proxy,
+                                 None if args.profile is None else os.path.abspath(args.profile))
+            total_found += found
+            total_elapsed += elapsed
+        print("all      %6d requests in %7.2fs: %8.2f requests/s" % (
+            total_found, total_elapsed, total_found / total_elapsed))
+    finally:
+        os.chdir(cwd)
+        server.shutdown()
+        if not args.keep:
+            shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+This file is part of foitorrent.
+Copyright (c) 2013  Brendan Molloy
+
+foitorrent is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+foitorrent is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with foitorrent.  If not, see <http://www.gnu.org/licenses/>.
+
+Concurrent load test for the web frontend. Either point it at a running
+server:
+
+    python -m foitorrent.benchmarks.web_latency --url http://localhost:8888/d/agd
+
+or run --compare, which serves the same simulated query (mostly fast,
+occasionally slow) from a handler that blocks the IOLoop and from one
+that goes through the database executor, and reports both.
+"""
+
+import argparse
+import concurrent.futures
+import random
+import time
+
+import tornado.httpclient
+import tornado.httpserver
+import tornado.ioloop
+import tornado.testing
+import tornado.web
+from tornado import gen
+
+from .. import web
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+@gen.coroutine
+def load(url, requests, concurrency):
+    client = tornado.httpclient.AsyncHTTPClient(max_clients=concurrency)
+    latencies = []
+    pending = iter(range(requests))
+
+    @gen.coroutine
+    def worker():
+        for n in pending:
+            start = time.time()
+            yield client.fetch(url, raise_error=False)
+            latencies.append(time.time() - start)
+
+    start = time.time()
+    yield [worker() for n in range(concurrency)]
+    return latencies, time.time() - start
+
+
+def report(label, latencies, elapsed):
+    ms = [x * 1000 for x in latencies]
+    print("%-10s %7.1f req/s  p50 %7.1fms  p90 %7.1fms  p99 %7.1fms  max %7.1fms" % (
+        label, len(ms) / elapsed, percentile(ms, 50), percentile(ms, 90),
+        percentile(ms, 99), max(ms)))
+
+
+def simulated_query(slow_fraction, slow_ms, fast_ms):
+    time.sleep((slow_ms if random.random() < slow_fraction else fast_ms) / 1000.0)
+    return "ok"
+
+
+def compare(args):
+    query = lambda: simulated_query(args.slow_fraction, args.slow_ms, args.fast_ms)
+    web.db_executor = concurrent.futures.ThreadPoolExecutor(max_workers=web.options.db_workers)
+
+    class BlockingHandler(tornado.web.RequestHandler):
+        def get(self):
+            self.write(query())
+
+    class ExecutorHandler(tornado.web.RequestHandler):
+        @gen.coroutine
+        def get(self):
+            result = yield web.run_db(query)
+            self.write(result)
+
+    for label, handler in [("blocking", BlockingHandler), ("executor", ExecutorHandler)]:
+        sock, port = tornado.testing.bind_unused_port()
+        server = tornado.httpserver.HTTPServer(tornado.web.Application([(r'/', handler)]))
+        server.add_sockets([sock])
+        latencies, elapsed = tornado.ioloop.IOLoop.current().run_sync(
+            lambda: load("http://127.0.0.1:%d/" % port, args.requests, args.concurrency))
+        server.stop()
+        report(label, latencies, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the web frontend.")
+    parser.add_argument('--url', default=None)
+    parser.add_argument('--compare', action='store_true')
+    parser.add_argument('-n', '--requests', type=int, default=2000)
+    parser.add_argument('-c', '--concurrency', type=int, default=50)
+    parser.add_argument('--slow-fraction', type=float, default=0.05)
+    parser.add_argument('--slow-ms', type=float, default=100)
+    parser.add_argument('--fast-ms', type=float, default=2)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args)
+    elif args.url is not None:
+        latencies, elapsed = tornado.ioloop.IOLoop.current().run_sync(
+            lambda: load(args.url, args.requests, args.concurrency))
+        report("url", latencies, elapsed)
+    else:
+        parser.error("give --url or --compare")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+This file is part of foitorrent.
+Copyright (c) 2013  Brendan Molloy
+
+foitorrent is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+foitorrent is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with foitorrent.  If not, see <http://www.gnu.org/licenses/>.
+
+How to scrape each department's disclosure log. Adding a department is
+adding a spec to SPECS; see extractor.py for what the keys mean.
+
+A value spec locates one node, relative to a listing row or a detail
+page, and converts it:
+
+    {"column": 2}                   the row's third cell
+    {"select": ".wc-title h1"}      the first match of a CSS selector
+    {"attr": "title"}               an attribute of the entry itself
+    "as": "text" | "html" | "date"  how to convert it (default text)
+    "match": regex                  keep only the regex's first group
+"""
+
+AGD = {
+    "organisation": "agd",
+    "base": "http://www.ag.gov.au/",
+    "date_formats": ["%A, %d %B %Y"],
+    "listing": {
+        "start": "http://www.ag.gov.au/RightsAndProtections/FOI/Pages/Freedomofinformationdisclosurelog.aspx",
+        # Oldest first, so a backfill walks the whole log.
+        "start_all": "http://www.ag.gov.au/RightsAndProtections/FOI/Pages/Freedomofinformationdisclosurelog.aspx?lsf=date&lso=0",
+        "entries": ".disclosure-log-list .dl-item-title a",
+        "next_page": ".paging-next a",
+        "newest_first": True,
+        "key": {"attr": "title"},
+        "key_field": "title",
+        # Entries link to a detail page, which is what metadata is read from.
+        "detail": True
+    },
+    "fields": {
+        "title": {"select": ".wc-title h1"},
+        "description": {"select": ".dl-abstract .dl-value"},
+        "date_released": {"select": ".dl-date .dl-value", "as": "date"}
+    },
+    "documents": {
+        "select": ".dl-downloads a",
+        # Word documents are linked through a viewer page.
+        "unwrap": {"path": "WordViewer.aspx", "param": "id"}
+    },
+    "fingerprint": {"select": ".dl-downloads a"}
+}
+
+DFAT = {
+    "organisation": "dfat",
+    "base": "http://www.dfat.gov.au/",
+    "date_formats": ["%d %B %Y"],
+    "listing": {
+        "start": "http://www.dfat.gov.au/foi/disclosure-log.html",
+        "entries": "#requests tbody tr",
+        "cells": 5,
+        "key": {"column": 0},
+        "key_field": "title"
+    },
+    "fields": {
+        "title": {"column": 0},
+        "reference": {"column": 0},
+        "description": {"column": 2, "as": "html"},
+        "date_released": {"column": 1, "as": "date"}
+    },
+    "documents": {"column": 3, "select": "a"}
+}
+
+DEFENCE = {
+    "organisation": "defence",
+    "base": "http://www.defence.gov.au/foi/",
+    "date_formats": ["%d-%b-%y", "%d-%B-%y", "%d-%b-%Y", "%d-%B-%Y"],
+    "listing": {
+        "start": "http://www.defence.gov.au/foi/disclosure_log.htm",
+        # The start page links to one log page per period.
+        "pages": ".homeBtn a",
+        "entries": "#table tbody tr",
+        "key": {"column": 1},
+        "key_field": "reference",
+        "title": {"select": ".foiTitle"}
+    },
+    "fields": {
+        "title": {"select": ".foiTitle"},
+        "reference": {"column": 1},
+        "access": {"column": 3},
+        "exemptions": {"column": 4},
+        "date_released": {"column": 0, "as": "date", "match": r"^(\S+)"}
+    },
+    "documents": {"column": 2, "select": "a"}
+}
+
+SPECS = [AGD, DFAT, DEFENCE]
@@ -0,0 +1,234 @@
+"""
+This file is part of foitorrent.
+Copyright (c) 2013  Brendan Molloy
+
+foitorrent is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+foitorrent is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with foitorrent.  If not, see <http://www.gnu.org/licenses/>.
+
+Runs the department specs in departments.py. A spec has:
+
+    organisation    stored on every request
+    base            what relative links are resolved against
+    date_formats    strptime formats for "as": "date" values
+    listing         where requests are listed:
+        start           the first listing page
+        start_all       optional; used instead of start to walk the whole log
+        entries         selector for one entry (a table row or a link)
+        cells           optional; skip rows without exactly this many cells
+        pages           optional; selector for links from the start page to
+                        the pages that hold the entries
+        next_page       optional; selector for the link to the next page
+        newest_first    stop at the first known entry unless walking it all
+        key, key_field  value identifying an entry, and the stored field it
+                        is compared with
+        title           optional value for logging; defaults to key
+        detail          entries link to a page with the metadata on it
+    fields          {field: value}, read from the entry or its detail page
+    documents       where the document links are, plus optional unwrap
+                    {"path", "param"} for links through a viewer page
+    fingerprint     "row" (default) or a value locating what to fingerprint
+"""
+
+import datetime
+import functools
+import logging
+import re
+import urllib.parse
+
+from .parsing import css, text, attr, html, fingerprint
+
+logger = logging.getLogger()
+
+
+class DateParser:
+    """strptime over a list of formats. The format that last worked is
+    tried first, since a log almost always uses the same one throughout,
+    and results are memoised as the same dates recur across entries and
+    runs."""
+
+    def __init__(self, formats, cache_size=4096):
+        self.formats = list(formats)
+        self.last = 0
+        self.parse = functools.lru_cache(maxsize=cache_size)(self._parse)
+
+    def _parse(self, s):
+        last = self.last
+        order = [last] + [n for n in range(len(self.formats)) if n != last]
+        for n in order:
+            try:
+                d = datetime.datetime.strptime(s, self.formats[n])
+            except ValueError:
+                continue
+            self.last = n
+            return d
+        raise ValueError("'%s' matches none of %s" % (s, ", ".join(self.formats)))
+
+
+class Extractor:
+    """One spec, compiled: every selector, regex and conversion is set up
+    here once, so extracting an entry is only lookups and calls."""
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.organisation = spec['organisation']
+        self.base = spec['base']
+        self.dates = DateParser(spec.get('date_formats', []))
+
+        listing = spec['listing']
+        self.entry_selector = css(listing['entries'])
+        self.cells = listing.get('cells')
+        self.cell_selector = css('td')
+        self.page_selector = css(listing['pages']) if 'pages' in listing else None
+        self.next_selector = css(listing['next_page']) if 'next_page' in listing else None
+        self.detail = listing.get('detail', False)
+        self.key = self.value(listing['key'])
+        self.title = self.value(listing.get('title', listing['key']))
+
+        self.fields = [(name, self.value(x)) for name, x in spec['fields'].items()]
+
+        documents = spec['documents']
+        self.document_nodes = self.locate_all(documents)
+        self.unwrap = documents.get('unwrap')
+
+        x = spec.get('fingerprint', 'row')
+        self.fingerprint_nodes = (lambda node: [node]) if x == 'row' else self.locate_all(x)
+
+    def locate(self, x):
+        column = x.get('column')
+        selector = css(x['select']) if 'select' in x else None
+
+        def find(node):
+            if column is not None:
+                if len(node) <= column:
+                    return None
+                node = node[column]
+            if selector is not None:
+                found = selector(node)
+                return found[0] if len(found) > 0 else None
+            return node
+        return find
+
+    def locate_all(self, x):
+        column = x.get('column')
+        selector = css(x['select']) if 'select' in x else None
+
+        def find(node):
+            if column is not None:
+                if len(node) <= column:
+                    return []
+                node = node[column]
+            return selector(node) if selector is not None else [node]
+        return find
+
+    def value(self, x):
+        """A function from a node to the value x describes, or None if the
+        node isn't there. Unparseable dates raise ValueError."""
+
+        find = self.locate(x)
+        name = x.get('attr')
+        kind = x.get('as', 'text')
+        match = re.compile(x['match']).match if 'match' in x else None
+        dates = self.dates.parse
+
+        def get(node):
+            node = find(node)
+            if node is None:
+                return None
+            if name is not None:
+                s = attr(node, name)
+                if s is None:
+                    return None
+            elif kind == 'html':
+                return html(node)
+            else:
+                s = text(node)
+            if match is not None:
+                m = match(s)
+                if m is None:
+                    return None
+                s = m.group(1)
+            return dates(s) if kind == 'date' else s
+        return get
+
+    def entries(self, page):
+        nodes = self.entry_selector(page)
+        if self.cells is None:
+            return nodes
+        return [x for x in nodes if len(self.cell_selector(x)) == self.cells]
+
+    def page_urls(self, page):
+        if self.page_selector is None:
+            return None
+        return [urllib.parse.urljoin(self.base, a.attrib['href'])
+                for a in self.page_selector(page) if 'href' in a.attrib]
+
+    def next_page(self, page):
+        if self.next_selector is None:
+            return None
+        found = self.next_selector(page)
+        if len(found) == 0 or 'href' not in found[0].attrib:
+            return None
+        return urllib.parse.urljoin(self.base, found[0].attrib['href'])
+
+    def entry_url(self, page_url, entry):
+        if self.detail:
+            return urllib.parse.urljoin(self.base, entry.attrib['href'])
+        return page_url
+
+    def fingerprint(self, node):
+        return fingerprint(*self.fingerprint_nodes(node))
+
+    def document_url(self, href):
+        url = urllib.parse.urljoin(self.base, href)
+        if self.unwrap is not None:
+            x = urllib.parse.urlparse(url)
+            if x.path.endswith(self.unwrap['path']):
+                target = urllib.parse.parse_qs(x.query).get(self.unwrap['param'])
+                if target:
+                    url = urllib.parse.urljoin(self.base, target[0])
+        return url
+
+    def metadata(self, url, node):
+        o = {
+            "organisation": self.organisation,
+            "fingerprint": self.fingerprint(node),
+            "date_retrieved": datetime.datetime.utcnow(),
+            "original_url": url,
+            "documents": []
+        }
+
+        for name, get in self.fields:
+            try:
+                x = get(node)
+            except ValueError as e:
+                logger.error("Bad %s for '%s': %s" % (name, url, e))
+                return
+            if x is None:
+                logger.error("No %s found for '%s'" % (name, url))
+                return
+            o[name] = x
+
+        for a in self.document_nodes(node):
+            href = a.attrib.get('href')
+            if href is None or href.startswith("mailto"):
+                logger.error("Invalid anchor: '%s'" % html(a))
+                return
+
+            doc_url = self.document_url(href)
+            o['documents'].append({
+                "original_url": doc_url,
+                "title": text(a),
+                "filename": urllib.parse.unquote(doc_url.rsplit('/', 1)[-1])
+            })
+
+        return o
@@ -0,0 +1,93 @@
+"""
+This file is part of foitorrent.
+Copyright (c) 2013  Brendan Molloy
+
+foitorrent is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+foitorrent is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with foitorrent.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import pymongo
+
+from xml.sax.saxutils import escape, quoteattr
+
+FEED_SIZE = 50
+
+ATOM_DATE = "%Y-%m-%dT%H:%M:%SZ"
+
+entry_template = """<entry>
+<id>{url}</id>
+<title>{title}</title>
+<updated>{updated}</updated>
+<published>{published}</published>
+<category term={organisation}/>
+<link rel="alternate" type="text/html" href={link}/>
+<link rel="enclosure" type="application/x-bittorrent" href={torrent}/>
+<summary type="html">{summary}</summary>
+</entry>
+"""
+
+feed_template = """<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+<id>{url}</id>
+<title>{title}</title>
+<updated>{updated}</updated>
+<link rel="self" type="application/atom+xml" href={self_link}/>
+<author><name>foitorrent</name></author>
+{entries}</feed>
+"""
+
+
+def render_entry(o, base_url):
+    url = "%s/r/%s" % (base_url, o['_id'])
+    return entry_template.format(
+        url=escape(url),
+        link=quoteattr(url),
+        torrent=quoteattr("%s/t/%s" % (base_url, o['_id'])),
+        title=escape(o['title']),
+        organisation=quoteattr(o['organisation']),
+        updated=o['date_retrieved'].strftime(ATOM_DATE),
+        published=o['date_released'].strftime(ATOM_DATE),
+        summary=escape(o.get('description', '')))
+
+
+def feed_entry(o, base_url):
+    """o's pre-rendered Atom entry, so feeds are assembled from stored
+    fragments rather than rebuilt from the requests on every poll."""
+
+    return {
+        "_id": o['_id'],
+        "organisation": o['organisation'],
+        "updated": o['date_retrieved'],
+        "xml": render_entry(o, base_url)
+    }
+
+
+def create_indexes(db):
+    db.feed_entries.create_index([("updated", pymongo.DESCENDING)])
+    db.feed_entries.create_index([("organisation", pymongo.ASCENDING),
+                                  ("updated", pymongo.DESCENDING)])
+
+
+def render_feed(db, org, self_link):
+    query = {} if org is None else {"organisation": org}
+    entries = list(db.feed_entries.find(query, {"xml": 1, "updated": 1})
+                   .sort("updated", pymongo.DESCENDING).limit(FEED_SIZE))
+
+    updated = entries[0]['updated'].strftime(ATOM_DATE) if len(entries) > 0 \
+              else "1970-01-01T00:00:00Z"
+    return feed_template.format(
+        url=escape(self_link),
+        self_link=quoteattr(self_link),
+        title=escape("foitorrent: %s" % ("all departments" if org is None else org)),
+        updated=updated,
+        entries="".join(x['xml'] for x in entries))
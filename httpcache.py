@@ -0,0 +1,166 @@
+"""
+This file is part of foitorrent.
+Copyright (c) 2013  Brendan Molloy
+
+foitorrent is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+foitorrent is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with foitorrent.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import os.path
+import threading
+import time
+
+
+class HTTPCache:
+    """On-disk store of response validators (ETag/Last-Modified) and page
+    bodies. Bodies are evicted least-recently-used first once their total
+    size exceeds max_size; documents are only tracked by their validators,
+    as their bodies already live in the request directories."""
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.index_path = os.path.join(path, 'index.json')
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.saved = 0
+
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                for url, entry in json.load(f):
+                    self.entries[url] = entry
+                    self.size += entry.get('body_size', 0)
+
+    def get(self, url):
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is None:
+                return None
+            self.entries.move_to_end(url)
+            return dict(entry)
+
+    def put(self, url, headers, **extra):
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if etag is None and last_modified is None:
+            self.remove(url)
+            return
+
+        entry = {"etag": etag, "last_modified": last_modified}
+        entry.update(extra)
+
+        with self.lock:
+            old = self.entries.pop(url, None)
+            if old is not None:
+                if old.get('body') != entry.get('body'):
+                    self._drop_body(old)
+                else:
+                    self.size -= old.get('body_size', 0)
+            self.entries[url] = entry
+            self.size += entry.get('body_size', 0)
+            self._evict()
+
+    def update(self, url, **fields):
+        with self.lock:
+            if url in self.entries:
+                self.entries[url].update(fields)
+
+    def remove(self, url):
+        with self.lock:
+            entry = self.entries.pop(url, None)
+            if entry is not None:
+                self._drop_body(entry)
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry.get('etag') is not None:
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified') is not None:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def validator(self, entry):
+        return entry.get('etag') or entry.get('last_modified')
+
+    def body_path(self, url):
+        return os.path.join(self.path, hashlib.sha1(url.encode()).hexdigest())
+
+    def read_body(self, url):
+        entry = self.get(url)
+        if entry is None or entry.get('body') is None:
+            return None
+        try:
+            with open(os.path.join(self.path, entry['body']), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            self.remove(url)
+            return None
+
+    def store_body(self, url, headers, body, **extra):
+        if headers.get('ETag') is None and headers.get('Last-Modified') is None:
+            self.remove(url)
+            return
+
+        fn = self.body_path(url)
+        tmp = fn + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(body)
+        os.replace(tmp, fn)
+
+        self.put(url, headers, body=os.path.basename(fn), body_size=len(body), **extra)
+
+    def save(self, max_age=None):
+        """Writes the index. With max_age, does nothing if it was written
+        less than max_age seconds ago, so callers saving after every
+        download don't rewrite a large index each time; a final save
+        without max_age is then needed."""
+
+        with self.save_lock:
+            now = time.time()
+            if max_age is not None and now - self.saved < max_age:
+                return
+            self.saved = now
+            with self.lock:
+                data = list(self.entries.items())
+            tmp = self.index_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp, self.index_path)
+
+    def _drop_body(self, entry):
+        if entry.get('body') is None:
+            return
+        self.size -= entry.get('body_size', 0)
+        try:
+            os.unlink(os.path.join(self.path, entry['body']))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        if self.size <= self.max_size:
+            return
+        for url in list(self.entries.keys()):
+            entry = self.entries[url]
+            if entry.get('body') is None:
+                continue
+            del self.entries[url]
+            self._drop_body(entry)
+            if self.size <= self.max_size:
+                return
@@ -0,0 +1,202 @@
+"""
+This file is part of foitorrent.
+Copyright (c) 2013  Brendan Molloy
+
+foitorrent is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+foitorrent is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with foitorrent.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import contextlib
+import cProfile
+import pstats
+import threading
+import time
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+class Registry:
+    """Thread-safe counters and timers. Snapshots are plain lists of dicts
+    so they can be stored in MongoDB and rendered in another process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timers = {}
+
+    def inc(self, name, n=1, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, name, seconds, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            t = self.timers.get(key)
+            if t is None:
+                t = self.timers[key] = [0, 0.0, 0.0]
+            t[0] += 1
+            t[1] += seconds
+            t[2] = max(t[2], seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "counters": [{"name": name, "labels": dict(labels), "value": value}
+                             for (name, labels), value in sorted(self.counters.items())],
+                "timers": [{"name": name, "labels": dict(labels), "count": t[0],
+                            "sum": t[1], "max": t[2]}
+                           for (name, labels), t in sorted(self.timers.items())]
+            }
+
+
+# Process-wide registry for shared components (the BitTorrent client, the
+# web handlers); each Scraper keeps its own so runs can be summarised.
+registry = Registry()
+
+
+def delta(before, after):
+    """What happened between two snapshots of the same registry. Timer
+    maxima can't be subtracted, so the later one is kept."""
+
+    def index(entries):
+        return dict((_key(x['name'], x['labels']), x) for x in entries)
+
+    old_counters = index(before['counters'])
+    old_timers = index(before['timers'])
+    counters = []
+    for x in after['counters']:
+        old = old_counters.get(_key(x['name'], x['labels']))
+        value = x['value'] - (0 if old is None else old['value'])
+        if value != 0:
+            counters.append(dict(x, value=value))
+    timers = []
+    for x in after['timers']:
+        old = old_timers.get(_key(x['name'], x['labels']))
+        if old is None:
+            timers.append(x)
+        elif x['count'] != old['count']:
+            timers.append(dict(x, count=x['count'] - old['count'], sum=x['sum'] - old['sum']))
+    return {"counters": counters, "timers": timers}
+
+
+def total(snapshot, name, field='value'):
+    """Sums a counter (or a timer's count/sum) across all its labels."""
+    kind = 'counters' if field == 'value' else 'timers'
+    return sum(x[field] for x in snapshot[kind] if x['name'] == name)
+
+
+def _labels(labels):
+    if len(labels) == 0:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                             for k, v in sorted(labels.items()))
+
+
+def render(snapshots, prefix="foitorrent"):
+    """Prometheus text exposition of (snapshot, extra_labels) pairs.
+    Counters become <prefix>_<name>_total; timers become summaries named
+    <prefix>_<name>_seconds plus a <prefix>_<name>_seconds_max gauge."""
+
+    families = {}
+    for snapshot, extra in snapshots:
+        for x in snapshot['counters']:
+            labels = dict(x['labels'], **extra)
+            families.setdefault(("%s_%s_total" % (prefix, x['name']), "counter"), []).append(
+                    "%s_%s_total%s %s" % (prefix, x['name'], _labels(labels), x['value']))
+        for x in snapshot['timers']:
+            labels = _labels(dict(x['labels'], **extra))
+            name = "%s_%s_seconds" % (prefix, x['name'])
+            families.setdefault((name, "summary"), []).extend([
+                "%s_count%s %d" % (name, labels, x['count']),
+                "%s_sum%s %.6f" % (name, labels, x['sum'])])
+            families.setdefault((name + "_max", "gauge"), []).append(
+                    "%s_max%s %.6f" % (name, labels, x['max']))
+
+    out = []
+    for (name, kind), lines in sorted(families.items()):
+        out.append("# TYPE %s %s" % (name, kind))
+        out.extend(lines)
+    return "\n".join(out) + "\n"
+
+
+class Profiler:
+    """cProfile across threads: every function passed through wrap() is
+    profiled in whichever thread runs it, and dump() merges the lot."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.profiles = []
+
+    def _profile(self):
+        profile = getattr(self.local, 'profile', None)
+        if profile is None:
+            profile = self.local.profile = cProfile.Profile()
+            self.local.registered = False
+        return profile
+
+    def _register(self, profile):
+        # Only once it has been enabled: a profile that never ran has no
+        # stats, and pstats refuses it.
+        if not self.local.registered:
+            self.local.registered = True
+            with self.lock:
+                self.profiles.append(profile)
+
+    def wrap(self, func):
+        def wrapper(*args, **kwargs):
+            profile = self._profile()
+            depth = getattr(self.local, 'depth', 0)
+            self.local.depth = depth + 1
+            enabled = False
+            if depth == 0:
+                try:
+                    profile.enable()
+                    enabled = True
+                    self._register(profile)
+                except ValueError:
+                    # Python 3.12+ allows only one active profiler per
+                    # process, so concurrent calls go unprofiled there.
+                    pass
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.local.depth = depth
+                if enabled:
+                    profile.disable()
+        return wrapper
+
+    def dump(self, path):
+        with self.lock:
+            profiles = list(self.profiles)
+        if len(profiles) == 0:
+            return
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            try:
+                stats.add(profile)
+            except TypeError:
+                # Nothing was recorded while it was enabled.
+                pass
+        stats.dump_stats(path)
@@ -0,0 +1,85 @@
+"""
+This file is part of foitorrent.
+Copyright (c) 2013  Brendan Molloy
+
+foitorrent is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+foitorrent is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with foitorrent.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import functools
+import hashlib
+import re
+
+import lxml.html
+from lxml.cssselect import CSSSelector
+
+CHARSET = re.compile(r'charset=["\']?([\w.:-]+)', re.I)
+WHITESPACE = re.compile(r'\s+')
+BETWEEN_TAGS = re.compile(r'>\s+<')
+
+
+def charset(content_type):
+    """The charset named in a Content-Type header, or None so that lxml
+    falls back to the document's own <meta> declaration."""
+
+    if content_type is None:
+        return None
+    m = CHARSET.search(content_type)
+    return None if m is None else m.group(1)
+
+
+@functools.lru_cache(maxsize=None)
+def html_parser(encoding):
+    return lxml.html.HTMLParser(encoding=encoding)
+
+
+def parse(content, encoding=None):
+    """Parses raw response bytes without decoding them to str first."""
+    return lxml.html.document_fromstring(content, parser=html_parser(encoding))
+
+
+@functools.lru_cache(maxsize=None)
+def css(selector):
+    """A compiled selector: the CSS to XPath translation happens once per
+    selector string rather than on every cssselect() call."""
+    return CSSSelector(selector, translator='html')
+
+
+def text(node):
+    return node.text_content().replace('\u00a0', ' ').strip()
+
+
+def attr(node, name):
+    """An attribute value normalised like text(), or None if it's absent.
+    Keys read from attributes must match values stored from text()."""
+
+    value = node.get(name)
+    return None if value is None else value.replace('\u00a0', ' ').strip()
+
+
+def html(node):
+    return lxml.html.tostring(node, encoding='unicode').replace('\u00a0', ' ').strip()
+
+
+def fingerprint(*nodes):
+    """sha1 of the nodes' markup with whitespace collapsed, so that
+    reindenting a page doesn't count as a change to its entries."""
+
+    m = hashlib.sha1()
+    for node in nodes:
+        markup = lxml.html.tostring(node, encoding='unicode', with_tail=False)
+        markup = BETWEEN_TAGS.sub('><', WHITESPACE.sub(' ', markup))
+        m.update(markup.strip().encode('utf-8'))
+        m.update(b'\0')
+    return m.hexdigest()
+
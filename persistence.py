@@ -0,0 +1,257 @@
+"""
+This file is part of foitorrent.
+Copyright (c) 2013  Brendan Molloy
+
+foitorrent is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+foitorrent is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with foitorrent.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import datetime
+import logging
+import threading
+import time
+
+import bson.objectid
+import pymongo
+import pymongo.errors
+from pymongo import DeleteOne, ReplaceOne, UpdateOne
+
+from . import metrics
+
+logger = logging.getLogger()
+
+# The steps a request goes through. Only published requests are in
+# db.requests; the others live in db.request_state until they get there,
+# and their entry is dropped once they do.
+STATES = ("discovered", "downloaded", "torrented", "seeded", "published")
+
+
+def reached(state, target):
+    return state is not None and STATES.index(state) >= STATES.index(target)
+
+
+def request_key(o):
+    """What identifies a request within its organisation: the department's
+    reference where it has one, otherwise the title."""
+    return o.get('reference') or o['title']
+
+
+def key_filter(o):
+    # Also matches requests stored before keys existed, by the field the
+    # key would have come from.
+    key = request_key(o)
+    field = 'reference' if o.get('reference') else 'title'
+    return {"organisation": o['organisation'],
+            "$or": [{"key": key}, {"key": {"$exists": False}, field: key}]}
+
+
+class RequestStore:
+    """Writes scraped requests. Published requests are upserted on
+    (organisation, key), so a request scraped twice is updated rather
+    than duplicated.
+
+    Every write of the scrape path (state transitions, request upserts,
+    feed and search entries, generation bumps) is buffered and written
+    with one bulk_write per collection every batch_size writes or
+    flush_interval seconds. Request writes land before the transitions
+    queued with them, so after a crash at most that much progress is
+    forgotten and those steps are simply redone."""
+
+    # The order buffered writes are flushed in.
+    COLLECTIONS = ("requests", "feed_entries", "search_index", "request_state")
+
+    def __init__(self, db, organisation, batch_size=100, flush_interval=5, registry=None):
+        self.db = db
+        self.organisation = organisation
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.metrics = registry if registry is not None else metrics.registry
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.pending = dict((name, []) for name in self.COLLECTIONS)
+        self.queued = 0
+        self.generations = {}
+        self.flushed = time.time()
+
+    def create_indexes(self):
+        self.db.request_state.create_index([("organisation", pymongo.ASCENDING),
+                                            ("key", pymongo.ASCENDING)], unique=True)
+        self.db.request_state.create_index([("organisation", pymongo.ASCENDING),
+                                            ("state", pymongo.ASCENDING)])
+        try:
+            # Partial, so requests stored before keys existed don't collide
+            # on a missing key until they are migrated.
+            self.db.requests.create_index(
+                    [("organisation", pymongo.ASCENDING), ("key", pymongo.ASCENDING)],
+                    unique=True, partialFilterExpression={"key": {"$exists": True}})
+        except pymongo.errors.OperationFailure as e:
+            logger.error("Could not create the unique request key index (%s); "
+                         "run 'python -m foitorrent.persistence migrate'" % e)
+
+    def queue(self, collection, op):
+        with self.lock:
+            self.pending[collection].append(op)
+            self.queued += 1
+            due = self.queued >= self.batch_size or \
+                  time.time() - self.flushed >= self.flush_interval
+        if due:
+            self.flush()
+
+    def transition(self, o, state):
+        selector = {"organisation": o['organisation'], "key": request_key(o)}
+        if state == STATES[-1]:
+            # Published: db.requests has it all now.
+            self.queue("request_state", DeleteOne(selector))
+            return
+        now = datetime.datetime.utcnow()
+        self.queue("request_state", UpdateOne(selector,
+                   {"$set": {"state": state, "request": o, "updated": now,
+                             "times.%s" % state: now}},
+                   upsert=True))
+
+    def replace(self, collection, doc):
+        self.queue(collection, ReplaceOne({"_id": doc['_id']}, doc, upsert=True))
+
+    def bump_generation(self, org):
+        # Lets the web frontend know its cached pages and feeds for org,
+        # and the all-departments feed ("*"), are stale. Bumps are summed
+        # and written with the next flush.
+        with self.lock:
+            for key in [org, "*"]:
+                self.generations[key] = self.generations.get(key, 0) + 1
+
+    def flush(self):
+        # Held across the write so batches land in the order they were
+        # queued, and a later state is never overwritten by an earlier one.
+        with self.flush_lock:
+            with self.lock:
+                pending = self.pending
+                generations = self.generations
+                self.pending = dict((name, []) for name in self.COLLECTIONS)
+                self.generations = {}
+                self.queued = 0
+                self.flushed = time.time()
+            for name in self.COLLECTIONS:
+                if len(pending[name]) > 0:
+                    with self.metrics.timer("db_query", op="bulk_write"):
+                        self.db[name].bulk_write(pending[name], ordered=True)
+            if len(generations) > 0:
+                with self.metrics.timer("db_query", op="bulk_write"):
+                    self.db.generations.bulk_write([
+                        UpdateOne({"_id": key}, {"$inc": {"n": n}}, upsert=True)
+                        for key, n in sorted(generations.items())], ordered=False)
+
+    def incomplete(self):
+        self.flush()
+        with self.metrics.timer("db_query", op="incomplete"):
+            return list(self.db.request_state.find({
+                "organisation": self.organisation,
+                "state": {"$ne": "published"}}).sort("updated", pymongo.ASCENDING))
+
+    def assign_id(self, o, previous=None):
+        """Gives o the id it will be stored under, before it is: previous's
+        for a request already stored as previous, otherwise a new one.
+        Later writes can then refer to it while the upsert is buffered."""
+
+        if o.get('_id') is None:
+            o['_id'] = previous['_id'] if previous is not None else bson.objectid.ObjectId()
+        return o['_id']
+
+    def upsert(self, o):
+        """Queues an insert or update of o in db.requests."""
+
+        if o.get('_id') is None:
+            # Resumed from a state recorded before ids were assigned early.
+            self.assign_id(o, self.find(o))
+        fields = dict((k, v) for k, v in o.items() if k != '_id')
+        fields['key'] = request_key(o)
+        self.queue("requests", UpdateOne(key_filter(o),
+                   {"$set": fields, "$setOnInsert": {"_id": o['_id']}}, upsert=True))
+        return o['_id']
+
+    def find(self, o):
+        with self.metrics.timer("db_query", op="find"):
+            return self.db.requests.find_one(key_filter(o))
+
+    def fingerprints(self, field, values):
+        """Stored fingerprints of this organisation's requests whose field
+        is one of values, in a single query: {value: fingerprint}, with
+        None for requests stored before fingerprints were recorded."""
+
+        values = list(set(values))
+        if len(values) == 0:
+            return {}
+        with self.metrics.timer("db_query", op="fingerprints"):
+            cursor = self.db.requests.find({
+                "organisation": self.organisation,
+                field: {"$in": values}}, {field: 1, "fingerprint": 1})
+            return dict((x[field], x.get('fingerprint')) for x in cursor)
+
+    def set_fingerprint(self, o):
+        with self.metrics.timer("db_query", op="set_fingerprint"):
+            self.db.requests.update_one(key_filter(o), {"$set": {"fingerprint": o['fingerprint']}})
+
+
+def migrate(db, batch_size=1000):
+    """Gives requests stored before keys existed their key, in bulk_write
+    batches, and reports any (organisation, key) duplicates, which must be
+    resolved by hand before the unique index can be built."""
+
+    ops = []
+    updated = 0
+    for o in db.requests.find({"key": {"$exists": False}},
+                              {"title": 1, "reference": 1, "organisation": 1}):
+        ops.append(UpdateOne({"_id": o['_id']}, {"$set": {"key": request_key(o)}}))
+        if len(ops) >= batch_size:
+            updated += db.requests.bulk_write(ops, ordered=False).modified_count
+            ops = []
+    if len(ops) > 0:
+        updated += db.requests.bulk_write(ops, ordered=False).modified_count
+    logger.info("Added keys to %d requests" % updated)
+
+    pruned = db.request_state.delete_many({"state": "published"}).deleted_count
+    logger.info("Pruned %d finished request states" % pruned)
+
+    duplicates = list(db.requests.aggregate([
+        {"$group": {"_id": {"organisation": "$organisation", "key": "$key"},
+                    "ids": {"$push": "$_id"}, "n": {"$sum": 1}}},
+        {"$match": {"n": {"$gt": 1}}}
+    ]))
+    for x in duplicates:
+        logger.warning("Duplicate request %s/%s: %s" % (
+            x['_id']['organisation'], x['_id']['key'], ", ".join(str(i) for i in x['ids'])))
+    return updated, len(duplicates)
+
+
+if __name__ == "__main__":
+    import argparse
+    from .scraper import Scraper
+
+    parser = argparse.ArgumentParser(description="Maintain stored request records.")
+    parser.add_argument('command', choices=['migrate', 'status'],
+                        help="migrate: add keys to old requests, drop finished request states "
+                             "and build the unique index; "
+                             "status: count unfinished requests by state")
+    args = parser.parse_args()
+
+    scraper = Scraper()
+    if args.command == 'migrate':
+        updated, duplicates = migrate(scraper.db)
+        if duplicates == 0:
+            scraper.store.create_indexes()
+    else:
+        for x in scraper.db.request_state.aggregate([
+                {"$match": {"state": {"$ne": "published"}}},
+                {"$group": {"_id": {"organisation": "$organisation", "state": "$state"},
+                            "n": {"$sum": 1}}}]):
+            logger.info("%s: %d %s" % (x['_id']['organisation'], x['n'], x['_id']['state']))
@@ -0,0 +1,132 @@
+"""
+This file is part of foitorrent.
+Copyright (c) 2013  Brendan Molloy
+
+foitorrent is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+foitorrent is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with foitorrent.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class Stage:
+    def __init__(self, name, func, workers, queue_size):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.next = None
+        self.lock = threading.Lock()
+        self.threads = []
+        self.running = 0
+        self.processed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.busy = 0.0
+
+    def start(self):
+        self.running = self.workers
+        for n in range(self.workers):
+            t = threading.Thread(target=self.run, name="%s-%d" % (self.name, n))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is _DONE:
+                break
+
+            start = time.time()
+            try:
+                result = self.func(item)
+            except Exception:
+                logger.exception("Stage '%s' failed" % self.name)
+                result = None
+                with self.lock:
+                    self.failed += 1
+            else:
+                with self.lock:
+                    if result is None:
+                        self.dropped += 1
+                    else:
+                        self.processed += 1
+            with self.lock:
+                self.busy += time.time() - start
+
+            if result is not None and self.next is not None:
+                self.next.queue.put(result)
+
+        with self.lock:
+            self.running -= 1
+            last = self.running == 0
+        if last and self.next is not None:
+            self.next.close()
+
+    def close(self):
+        for n in range(self.workers):
+            self.queue.put(_DONE)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "processed": self.processed,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "queued": self.queue.qsize(),
+                "busy_seconds": self.busy,
+                "items_per_second": self.processed / self.busy if self.busy > 0 else 0.0
+            }
+
+
+class Pipeline:
+    """Chain of stages joined by bounded queues. Each stage function takes
+    an item and returns the item for the next stage, or None to drop it.
+    A full queue blocks the stage in front of it, bounding memory use."""
+
+    def __init__(self, queue_size=4):
+        self.queue_size = queue_size
+        self.stages = []
+
+    def add_stage(self, name, func, workers=1):
+        stage = Stage(name, func, workers, self.queue_size)
+        if len(self.stages) > 0:
+            self.stages[-1].next = stage
+        self.stages.append(stage)
+        return self
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+        return self
+
+    def put(self, item):
+        self.stages[0].queue.put(item)
+
+    def join(self):
+        self.stages[0].close()
+        for stage in self.stages:
+            for t in stage.threads:
+                t.join()
+
+    def stats(self):
+        return dict((stage.name, stage.stats()) for stage in self.stages)
@@ -0,0 +1,284 @@
+"""
+This file is part of foitorrent.
+Copyright (c) 2013  Brendan Molloy
+
+foitorrent is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+foitorrent is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with foitorrent.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import concurrent.futures
+import hashlib
+import logging
+import os
+import os.path
+import threading
+import time
+
+import bson.objectid
+
+from .scraper import Scraper
+from .torrents import TorrentBuilder, TorrentCreationError, bencode, bdecode
+
+logger = logging.getLogger()
+
+
+class Regenerator:
+    """Rebuilds the .torrent of every stored request with the current
+    trackers and comment, re-downloading only documents whose size (and
+    with verify, sha256) no longer match the database. Existing piece
+    hashes are reused when nothing was re-downloaded and the file list is
+    unchanged, and the .torrent is only rewritten when its metadata
+    actually differs."""
+
+    def __init__(self, scraper, checkpoint='regenerate.checkpoint', workers=4,
+                 processes=None, verify=False):
+        self.scraper = scraper
+        self.checkpoint = checkpoint
+        self.workers = workers
+        self.processes = processes
+        self.verify = verify
+        self.lock = threading.Lock()
+        self.counts = {"requests": 0, "unchanged": 0, "rewritten": 0, "rehashed": 0,
+                       "downloaded": 0, "failed": 0}
+        self.bytes_hashed = 0
+
+    def load_checkpoint(self):
+        if not os.path.exists(self.checkpoint):
+            return None
+        with open(self.checkpoint) as f:
+            return bson.objectid.ObjectId(f.read().strip())
+
+    def save_checkpoint(self, oid):
+        tmp = self.checkpoint + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(oid))
+        os.replace(tmp, self.checkpoint)
+
+    def clear_checkpoint(self):
+        if os.path.exists(self.checkpoint):
+            os.unlink(self.checkpoint)
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.counts[key] += n
+
+    def document_matches(self, path, meta):
+        fn = os.path.join(path, meta['filename'])
+        if not os.path.exists(fn) or os.path.getsize(fn) != meta.get('size'):
+            return False
+        if not self.verify:
+            return True
+        m = hashlib.sha256()
+        with open(fn, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                m.update(chunk)
+        return m.hexdigest() == meta.get('sha256')
+
+    def discard_document(self, path, meta):
+        """Forgets a missing or damaged copy so it is downloaded afresh:
+        the file, the blob it is a hardlink of (damaged with it), and the
+        cache entry, whose validators would only get a 304."""
+
+        fn = os.path.join(path, meta['filename'])
+        if os.path.exists(fn):
+            blob = None if meta.get('sha256') is None else self.scraper.blobs.path(meta['sha256'])
+            if blob is not None and os.path.exists(blob) and os.path.samefile(fn, blob):
+                os.unlink(blob)
+            os.unlink(fn)
+        self.scraper.cache.remove(meta['original_url'])
+
+    def regenerate(self, o):
+        config = self.scraper.config
+        path = self.scraper.generate_request_path(o)
+
+        changed_docs = [meta for meta in o['documents']
+                        if not self.document_matches(path, meta)]
+        if len(changed_docs) > 0:
+            os.makedirs(path, exist_ok=True)
+            for meta in changed_docs:
+                self.discard_document(path, meta)
+                self.scraper.download_document(path, meta)
+            self.scraper.db.requests.update_one({"_id": o['_id']},
+                    {"$set": {"documents": o['documents']}})
+            self.count("downloaded", len(changed_docs))
+
+        torrent_path = self.scraper.torrent_file(o)
+        old = None
+        if os.path.exists(torrent_path):
+            with open(torrent_path, 'rb') as f:
+                old = bdecode(f.read())
+
+        builder = TorrentBuilder(path, config['trackers'], config['comment'],
+                                 processes=self.processes)
+        pieces = None
+        # Rewritten documents can differ with the same size, so their old
+        # piece hashes can't be trusted.
+        if old is not None and len(changed_docs) == 0:
+            old_info = dict(old['info'])
+            pieces = old_info.pop('pieces')
+            new_info = builder.info(b"")
+            del new_info['pieces']
+            if bencode(old_info) != bencode(new_info):
+                pieces = None
+
+        if pieces is None:
+            pieces = builder.hash_pieces()
+            self.count("rehashed")
+            with self.lock:
+                self.bytes_hashed += builder.total_size
+
+        if old is not None:
+            builder.creation_date = old.get('creation date')
+            if bencode(builder.metainfo(pieces)) == bencode(old):
+                self.count("unchanged")
+                return
+
+        infohash = self.scraper.torrents.put(builder.build(pieces))
+        replaced = o.get('infohash')
+        if infohash != replaced:
+            self.scraper.db.requests.update_one({"_id": o['_id']}, {"$set": {
+                "torrent": self.scraper.torrents.relative_path(infohash),
+                "infohash": infohash
+            }})
+        torrent_path = self.scraper.torrents.path(infohash)
+        self.count("rewritten")
+        logger.info("Regenerated torrent: '%s'" % torrent_path)
+        return torrent_path, path, infohash, replaced
+
+    def run_one(self, o):
+        try:
+            return self.regenerate(o)
+        except (TorrentCreationError, OSError) as e:
+            logger.error("Regeneration of '%s' failed: %s" % (o['title'], e))
+            self.count("failed")
+            return False
+        finally:
+            self.count("requests")
+
+    def seed(self, rewritten):
+        """Hands a batch's new torrents to the client in one add_torrents
+        call and retires the torrents they replace. A rewrite that kept
+        its info hash is already seeding, so only its trackers change."""
+
+        client = self.scraper.client
+        for t, path, h, old in rewritten:
+            if h != old:
+                continue
+            try:
+                with self.scraper.metrics.timer("client_call", method="set_trackers"):
+                    client.set_trackers(h, self.scraper.config['trackers'])
+            except Exception as e:
+                logger.warning("Could not update trackers of '%s': %s" % (t, e))
+
+        added = [x for x in rewritten if x[2] != x[3]]
+        if len(added) == 0:
+            return
+        try:
+            with self.scraper.metrics.timer("client_call", method="add_torrents"):
+                client.add_torrents([(t, path) for t, path, h, old in added])
+        except Exception as e:
+            logger.warning("Could not seed %d regenerated torrents: %s" % (len(added), e))
+            return
+        for t, path, h, old in added:
+            if old is not None:
+                self.scraper.retire_torrent(old)
+
+    def run(self, query=None, restart=False):
+        query = dict(query or {})
+        query['torrent'] = {"$exists": True}
+        last = None if restart else self.load_checkpoint()
+        if last is not None:
+            logger.info("Resuming after %s" % last)
+            query['_id'] = {"$gt": last}
+
+        start = time.time()
+        self.stalled = False
+        batch_size = self.workers * 4
+        cursor = self.scraper.db.requests.find(query).sort("_id", 1)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            batch = []
+            for o in cursor:
+                batch.append(o)
+                if len(batch) >= batch_size:
+                    self.run_batch(pool, batch, start)
+                    batch = []
+            if len(batch) > 0:
+                self.run_batch(pool, batch, start)
+
+        # A finished run starts the next one from the beginning, unless
+        # something failed and has to be retried from the checkpoint.
+        if not self.stalled:
+            self.clear_checkpoint()
+        self.scraper.cache.save()
+        self.report(start)
+        return self.counts
+
+    def run_batch(self, pool, batch, start):
+        results = list(pool.map(self.run_one, batch))
+        self.seed([x for x in results if x])
+
+        # The checkpoint never moves past a failed request, so a resumed
+        # run retries it; everything before it is already done.
+        last = None
+        for o, result in zip(batch, results):
+            if result is False:
+                self.stalled = True
+            if self.stalled:
+                break
+            last = o['_id']
+        if last is not None:
+            self.save_checkpoint(last)
+        self.report(start)
+
+    def report(self, start):
+        elapsed = max(time.time() - start, 1e-6)
+        with self.lock:
+            counts = dict(self.counts)
+            mb = self.bytes_hashed / (1024 * 1024)
+        logger.info("%(requests)d requests: %(rewritten)d rewritten, %(unchanged)d unchanged, "
+                    "%(rehashed)d rehashed, %(downloaded)d documents downloaded, "
+                    "%(failed)d failed" % counts)
+        logger.info("%.2f requests/s, %.1f MB/s hashed" % (counts['requests'] / elapsed,
+                                                           mb / elapsed))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Regenerate stored .torrent files.")
+    parser.add_argument('--organisation', default=None)
+    parser.add_argument('--tracker', action='append', default=None,
+                        help="replace the configured trackers (repeatable)")
+    parser.add_argument('--comment', default=None)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--processes', type=int, default=None,
+                        help="piece hashing processes (default: one per CPU)")
+    parser.add_argument('--verify', action='store_true',
+                        help="check document sha256 as well as size")
+    parser.add_argument('--checkpoint', default='regenerate.checkpoint')
+    parser.add_argument('--restart', action='store_true',
+                        help="ignore the checkpoint and start from the beginning")
+    args = parser.parse_args()
+
+    scraper = Scraper()
+    if args.tracker is not None:
+        scraper.config['trackers'] = args.tracker
+    if args.comment is not None:
+        scraper.config['comment'] = args.comment
+
+    query = {}
+    if args.organisation is not None:
+        query['organisation'] = args.organisation
+
+    Regenerator(scraper, args.checkpoint, args.workers, args.processes,
+                args.verify).run(query, args.restart)
@@ -0,0 +1,153 @@
+"""
+This file is part of foitorrent.
+Copyright (c) 2013  Brendan Molloy
+
+foitorrent is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+foitorrent is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with foitorrent.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import concurrent.futures
+import datetime
+import heapq
+import logging
+import os
+import random
+import threading
+import time
+import urllib.parse
+
+import pymongo
+
+from .scraper import scrapers
+from .torrents import TransmissionClient
+
+logger = logging.getLogger()
+
+
+class HostRateLimiter:
+    """Spaces requests to the same host at least 1/rate seconds apart."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next_slot = {}
+
+    def wait(self, url):
+        host = urllib.parse.urlparse(url).netloc
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot.get(host, 0))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class Scheduler:
+    def __init__(self, departments, intervals, jitter=300, rate=2.0, fingerprint=False):
+        self.db = pymongo.MongoClient().foitorrent
+        self.client = TransmissionClient()
+        self.limiter = HostRateLimiter(rate)
+        self.jitter = jitter
+        self.intervals = intervals
+
+        first = scrapers[departments[0]](db=self.db, client=self.client, limiter=self.limiter)
+        self.scrapers = {departments[0]: first}
+        for dept in departments[1:]:
+            self.scrapers[dept] = scrapers[dept](db=self.db, client=self.client,
+                    session=first.session, cache=first.cache, limiter=self.limiter,
+                    blobs=first.blobs)
+
+        for scraper in self.scrapers.values():
+            scraper.config['fingerprint'] = fingerprint
+
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.scrapers))
+        self.running = set()
+
+    def next_run(self, dept):
+        return time.time() + self.intervals[dept] + random.uniform(0, self.jitter)
+
+    def run_once(self, dept):
+        started = datetime.datetime.utcnow()
+        start = time.time()
+        record = {"organisation": dept, "started": started}
+        try:
+            record['new_requests'] = self.scrapers[dept].scrape()
+        except Exception as e:
+            logger.exception("Scrape of '%s' failed" % dept)
+            record['error'] = repr(e)
+        record['duration'] = time.time() - start
+        record['stages'] = self.scrapers[dept].pipeline_stats
+        record['rates'] = self.scrapers[dept].run_summary.get('rates')
+        record['metrics'] = self.scrapers[dept].run_summary.get('metrics')
+
+        self.db.scrape_runs.insert_one(record)
+        logger.info("Scrape of '%s' finished in %.1fs with %s new requests" % (
+            dept, record['duration'], record.get('new_requests')))
+        return record
+
+    def run(self):
+        queue = [(time.time() + random.uniform(0, self.jitter), dept)
+                 for dept in self.scrapers]
+        heapq.heapify(queue)
+
+        while True:
+            when, dept = heapq.heappop(queue)
+            delay = when - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            if dept in self.running:
+                logger.warning("Scrape of '%s' still running; skipping this slot" % dept)
+            else:
+                self.running.add(dept)
+                future = self.pool.submit(self.run_once, dept)
+                future.add_done_callback(lambda f, dept=dept: self.running.discard(dept))
+
+            heapq.heappush(queue, (self.next_run(dept), dept))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Poll FOI disclosure logs continuously.")
+    parser.add_argument('departments', nargs='*',
+                        help="departments to poll: %s (default: all)" % ", ".join(sorted(scrapers.keys())))
+    parser.add_argument('--interval', type=int, default=3600,
+                        help="default seconds between polls")
+    parser.add_argument('--dept-interval', action='append', default=[], metavar='DEPT=SECONDS',
+                        help="per-department polling interval")
+    parser.add_argument('--jitter', type=int, default=300,
+                        help="maximum random delay added to each poll, in seconds")
+    parser.add_argument('--rate', type=float, default=2.0,
+                        help="maximum requests per second to each host")
+    parser.add_argument('--fingerprint', action='store_true',
+                        help="also re-fetch known entries whose listing or document list changed")
+    parser.add_argument('--profile', default=None, metavar='DIR',
+                        help="write cProfile stats for the first scrape of each department "
+                             "to DIR/<department>.prof")
+    args = parser.parse_args()
+
+    departments = args.departments or sorted(scrapers.keys())
+    for dept in departments:
+        if dept not in scrapers:
+            parser.error("unknown department '%s'" % dept)
+    intervals = dict((dept, args.interval) for dept in departments)
+    for item in args.dept_interval:
+        dept, seconds = item.split('=', 1)
+        intervals[dept] = int(seconds)
+
+    scheduler = Scheduler(departments, intervals, args.jitter, args.rate, args.fingerprint)
+    if args.profile is not None:
+        os.makedirs(args.profile, exist_ok=True)
+        for dept, scraper in scheduler.scrapers.items():
+            scraper.config['profile_path'] = os.path.join(args.profile, "%s.prof" % dept)
+    scheduler.run()
@@ -21,7 +21,6 @@ import pymongo
 import datetime
 import os
 import os.path
-import lxml.html
 import hashlib
 import re
 import logging
@@ -29,8 +28,25 @@ import tornado.log
 import string
 import urllib.parse
 import subprocess
-
-from .torrents import TransmissionClient
+import threading
+import concurrent.futures
+import requests.adapters
+import tempfile
+import json
+import time
+
+from .torrents import TransmissionClient, StreamingPieceHasher, TorrentCreationError
+from .httpcache import HTTPCache
+from .parsing import fingerprint
+from .extractor import Extractor
+from .persistence import RequestStore, reached, request_key
+from .pipeline import Pipeline
+from .storage import TorrentStore, BlobStore
+from . import departments
+from . import feeds
+from . import metrics
+from . import parsing
+from . import search
 
 logger = logging.getLogger()
 ch = logging.StreamHandler()
@@ -40,29 +56,184 @@ logger.setLevel(logging.INFO)
 
 
 class Scraper:
-    def __init__(self):
-        self.db = pymongo.Connection().foitorrent
-        self.session = requests.Session()
-        self.client = TransmissionClient()
+    ORGANISATION = None
+
+    def __init__(self, db=None, session=None, client=None, cache=None, limiter=None,
+                 blobs=None):
+        self.db = db if db is not None else pymongo.MongoClient().foitorrent
+        self.metrics = metrics.Registry()
+        self.store = RequestStore(self.db, self.ORGANISATION, registry=self.metrics)
+        self.create_indexes()
+        self._client = client
         self.config = {
             'path': 'requests',
             'torrent_path': 'torrents',
             'trackers': ['udp://tracker.publicbt.com:80/announce',
                 'udp://tracker.openbittorrent.com:80/announce'],
-            "comment": "Torrent retrieved from foitorrent: http://foitorrent.brendan.so"
+            "comment": "Torrent retrieved from foitorrent: http://foitorrent.brendan.so",
+            'base_url': "http://foitorrent.brendan.so",
+            'download_workers': 4,
+            'connections_per_host': 4,
+            'chunk_size': 64 * 1024,
+            'cache_path': 'cache',
+            'blob_path': 'blobs',
+            'cache_size': 256 * 1024 * 1024,
+            'cache_save_interval': 5,
+            'crawl_workers': 8,
+            'queue_size': 4,
+            'stage_workers': {'fetch': 2, 'torrent': 1, 'seed': 1, 'persist': 1, 'index': 1},
+            'fingerprint': False,
+            'summary_path': 'runs',
+            'profile_path': None
         }
+        self.session = session if session is not None else self.create_session()
+        self.cache = cache if cache is not None else HTTPCache(
+                self.config['cache_path'], self.config['cache_size'])
+        self.limiter = limiter
+        self.torrents = TorrentStore(self.config['torrent_path'])
+        self.blobs = blobs if blobs is not None else BlobStore(self.config['blob_path'])
+        self._host_semaphores = {}
+        self._host_semaphores_lock = threading.Lock()
+        self._crawler = None
+        self.pipeline_stats = {}
+        self.in_flight = set()
+        self.in_flight_lock = threading.Lock()
+        self.profiler = None
+        self.run_summary = {}
+
+    def create_indexes(self):
+        self.db.requests.create_index([("organisation", pymongo.ASCENDING),
+                                       ("title", pymongo.ASCENDING)])
+        self.db.requests.create_index([("organisation", pymongo.ASCENDING),
+                                       ("reference", pymongo.ASCENDING)])
+        self.db.requests.create_index("infohash")
+        self.db.requests.create_index([("organisation", pymongo.ASCENDING),
+                                       ("date_released", pymongo.DESCENDING),
+                                       ("_id", pymongo.DESCENDING)])
+        # For /api/requests without an organisation, which streams the
+        # whole collection in this order.
+        self.db.requests.create_index([("date_released", pymongo.ASCENDING),
+                                       ("_id", pymongo.ASCENDING)])
+        self.store.create_indexes()
+        feeds.create_indexes(self.db)
+        search.create_indexes(self.db)
+
+    def create_session(self):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+                pool_maxsize=self.config['connections_per_host'])
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def host_semaphore(self, url):
+        host = urllib.parse.urlparse(url).netloc
+        with self._host_semaphores_lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.BoundedSemaphore(
+                        self.config['connections_per_host'])
+            return self._host_semaphores[host]
+
+    def throttle(self, url):
+        if self.limiter is not None:
+            self.limiter.wait(url)
 
     def download_page(self, url):
-        return lxml.html.fromstring(re.sub('Â?\u00a0', ' ', self.session.get(url).text))
+        with self.metrics.timer("page_fetch"):
+            return self._download_page(url)
+
+    def _download_page(self, url):
+        entry = self.cache.get(url)
+        headers = {} if entry is None else self.cache.conditional_headers(entry)
+
+        # Shares the per-host limit with document downloads, so crawling and
+        # downloading together never need more connections than the pool.
+        with self.host_semaphore(url):
+            self.throttle(url)
+            resp = self.session.get(url, headers=headers)
+            content = None
+            if resp.status_code == 304:
+                content = self.cache.read_body(url)
+                if content is not None:
+                    logger.debug("Not modified: '%s'" % url)
+                    self.metrics.inc("pages", status="not_modified")
+                    # Entries cached before encodings were recorded hold UTF-8.
+                    encoding = entry.get('encoding', 'utf-8')
+                else:
+                    self.throttle(url)
+                    resp = self.session.get(url)
+
+            if content is None:
+                content = resp.content
+                encoding = parsing.charset(resp.headers.get('Content-Type'))
+                self.cache.store_body(url, resp.headers, content, encoding=encoding)
+                self.metrics.inc("pages", status="downloaded")
+                self.metrics.inc("page_bytes", len(content))
+
+        with self.metrics.timer("page_parse"):
+            return parsing.parse(content, encoding)
+
+    @property
+    def client(self):
+        # Connected on first use, so the maintenance commands that only
+        # need the database and stores work without a running daemon.
+        if self._client is None:
+            self._client = TransmissionClient()
+        return self._client
+
+    @property
+    def crawler(self):
+        if self._crawler is None:
+            self._crawler = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.config['crawl_workers'])
+        return self._crawler
+
+    def prefetch_page(self, url):
+        return self.crawler.submit(self.profiled(self.download_page), url)
+
+    def download_pages(self, urls):
+        return self.crawler.map(self.profiled(self.download_page), urls)
+
+    def profiled(self, func):
+        return func if self.profiler is None else self.profiler.wrap(func)
+
+    def generate_torrent(self, directory, fn, hasher=None):
+        incoming = os.path.join(self.config['torrent_path'], '.incoming')
+        os.makedirs(incoming, exist_ok=True)
+        fd, torrent_fn = tempfile.mkstemp(prefix=self.sanitise_torrent_name(fn)[:64], dir=incoming)
+        os.close(fd)
 
-    def generate_torrent(self, directory, fn):
-        torrent_fn = os.path.join(self.config['torrent_path'], self.sanitise_torrent_name(fn))
-        return self.client.create_torrent(torrent_fn, directory, self.config['trackers'],
-                                          comment=self.config['comment'])
+        try:
+            self.client.create_torrent(torrent_fn, directory, self.config['trackers'],
+                                       comment=self.config['comment'], hasher=hasher)
+            return self.torrents.add_file(torrent_fn)
+        finally:
+            if os.path.exists(torrent_fn):
+                os.unlink(torrent_fn)
+
+    def torrent_file(self, o):
+        if 'infohash' in o:
+            return self.torrents.path(o['infohash'])
+        return os.path.join(self.config['torrent_path'], self.sanitise_torrent_name(o['torrent']))
 
     def seed_torrent(self, torrent_path, files_path):
-        # TODO: put torrents in saner places, flat is not sustainable
-        self.client.add_torrent(torrent_path, files_path)
+        with self.metrics.timer("client_call", method="add_torrent"):
+            self.client.add_torrent(torrent_path, files_path)
+
+    def retire_torrent(self, infohash):
+        """Stops seeding a superseded torrent, whose files have been
+        replaced or removed, and drops its .torrent unless another request
+        still uses it."""
+
+        if self.db.requests.count_documents({"infohash": infohash}, limit=1) > 0:
+            return
+        logger.info("Retiring torrent %s" % infohash)
+        try:
+            with self.metrics.timer("client_call", method="remove_torrent"):
+                self.client.remove_torrent(infohash)
+        except Exception as e:
+            logger.warning("Could not remove torrent %s: %s" % (infohash, e))
+        self.torrents.remove(infohash)
 
     def sanitise_request_directory(self, path):
         return re.sub("[" + string.punctuation + r"\s’‘]", '_', path)
@@ -77,27 +248,129 @@ class Scraper:
                 self.sanitise_request_directory(o['title'])
             )
 
-    def download_documents(self, path, documents):
+    def content_length(self, resp):
+        if 'Content-Encoding' in resp.headers or 'Content-Length' not in resp.headers:
+            return None
+        return int(resp.headers['Content-Length'])
+
+    def download_document(self, path, meta, index=None, hasher=None):
+        url = meta['original_url']
+        fname = meta['filename']
+        fpath = os.path.join(path, fname)
+        part = os.path.join(path, '.%s.part' % fname)
+
+        logger.info("Downloading '%s'..." % url)
+        start = time.time()
+        entry = self.cache.get(url)
+        headers = {}
+        offset = 0
+
+        if entry is not None:
+            if entry.get('sha256') is not None and (os.path.exists(fpath) or
+                    self.blobs.has(entry['sha256'], entry.get('size'))):
+                headers.update(self.cache.conditional_headers(entry))
+            elif os.path.exists(part):
+                offset = os.path.getsize(part)
+                headers['Range'] = 'bytes=%d-' % offset
+                headers['If-Range'] = self.cache.validator(entry)
+
+        m = hashlib.sha256()
+        size = 0
+
+        with self.host_semaphore(url):
+            self.throttle(url)
+            resp = self.session.get(url, headers=headers, stream=True)
+            if resp.status_code == 416 and offset > 0:
+                # The .part can't be resumed, e.g. it is already complete:
+                # drop it and fetch the whole document.
+                resp.close()
+                logger.info("Cannot resume '%s'; downloading it again" % url)
+                os.unlink(part)
+                offset = 0
+                self.throttle(url)
+                resp = self.session.get(url, stream=True)
+            try:
+                if resp.status_code == 304:
+                    meta['size'] = entry['size']
+                    meta['sha256'] = entry['sha256']
+                    if not os.path.exists(fpath):
+                        self.blobs.restore(meta['sha256'], fpath)
+                    if hasher is not None:
+                        hasher.finish(index, fpath, meta['size'])
+                    logger.info("Not modified: '%s' :: SHA256: %s" % (fpath, meta['sha256']))
+                    self.metrics.inc("documents", status="not_modified")
+                    self.metrics.observe("document_download", time.time() - start)
+                    return
+
+                # Anything else is an error page, not the document.
+                if resp.status_code not in (200, 206) or \
+                        (resp.status_code == 206 and offset == 0):
+                    raise requests.HTTPError("Unexpected status %d for '%s'" % (
+                        resp.status_code, url), response=resp)
+
+                if offset > 0 and resp.status_code == 206:
+                    logger.info("Resuming '%s' from byte %d" % (url, offset))
+                    with open(part, 'rb') as f:
+                        for chunk in iter(lambda: f.read(self.config['chunk_size']), b''):
+                            m.update(chunk)
+                            size += len(chunk)
+                    mode = 'ab'
+                else:
+                    self.cache.put(url, resp.headers)
+                    self.cache.save(self.config['cache_save_interval'])
+                    mode = 'wb'
+
+                length = self.content_length(resp)
+                if hasher is not None and length is not None:
+                    hasher.set_size(index, size + length)
+
+                with open(part, mode) as f:
+                    for chunk in resp.iter_content(self.config['chunk_size']):
+                        m.update(chunk)
+                        f.write(chunk)
+                        if hasher is not None:
+                            f.flush()
+                            hasher.wrote(index, part, size, chunk)
+                        size += len(chunk)
+            finally:
+                resp.close()
+
+        os.replace(part, fpath)
+        if hasher is not None:
+            hasher.finish(index, fpath, size)
+
+        meta['size'] = size
+        meta['sha256'] = m.hexdigest()
+        self.cache.update(url, size=size, sha256=meta['sha256'])
+        if self.blobs.link(fpath, meta['sha256']):
+            logger.info("Deduplicated: '%s'" % fpath)
+
+        logger.info("Downloaded: '%s' :: SHA256: %s" % (fpath, meta['sha256']))
+        self.metrics.inc("documents", status="resumed" if offset > 0 else "downloaded")
+        self.metrics.inc("document_bytes", size - offset)
+        self.metrics.observe("document_download", time.time() - start)
+
+    def download_documents(self, path, documents, hasher=None):
         if len(documents) == 0:
             return
 
-        for meta in documents:
-            fname = meta['filename']
-            os.makedirs(path, exist_ok=True)
-
-            logger.info("Downloading '%s'..." % meta['original_url'])
-            document = requests.get(meta['original_url']).content
-            meta['size'] = len(document)
-
-            m = hashlib.sha256()
-            m.update(document)
-            meta['sha256'] = m.hexdigest()
+        os.makedirs(path, exist_ok=True)
 
-            with open(os.path.join(path, fname), 'wb') as f:
-                f.write(document)
-
-            logger.info("Downloaded: '%s' :: SHA256: %s" % (
-                        os.path.join(path, fname), meta['sha256']))
+        workers = min(self.config['download_workers'], len(documents))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            download = self.profiled(self.download_document)
+            futures = [pool.submit(download, path, meta, n, hasher)
+                       for n, meta in enumerate(documents)]
+            try:
+                for n, future in enumerate(futures):
+                    try:
+                        future.result()
+                    except:
+                        if hasher is not None:
+                            hasher.fail(n)
+                        raise
+            finally:
+                self.cache.save(self.config['cache_save_interval'])
 
 
     def sanitise_torrent_name(self, fn):
@@ -109,314 +382,421 @@ class Scraper:
     def find_new_documents(self, page):
         raise NotImplementedError
 
-    def scrape_request(self, url, node=None):
+    def claim(self, o):
+        # Stops a request being worked on twice in one run, e.g. when it
+        # is both resumed and rediscovered on the listing.
+        key = request_key(o)
+        with self.in_flight_lock:
+            if key in self.in_flight:
+                return False
+            self.in_flight.add(key)
+            return True
+
+    def fetch_request(self, job):
+        if job.get('resume') is not None:
+            return self.resume_request(job['resume'])
+
+        node = job.get('node')
         if node is None:
-            node = self.download_page(url)
-        o = self.generate_metadata(url, node)
+            node = self.download_page(job['url'])
+        o = self.generate_metadata(job['url'], node)
 
         if o is None:
             logger.error("Skipping request due to errors!")
             return
 
-        fpath = self.generate_request_path(o)
-        self.download_documents(fpath, o['documents'])
-
         if len(o['documents']) == 0:
             logger.error('No documents found for this request! Skipping.')
             return
 
+        previous = None
+        if 'fingerprint' in job:
+            # A known request, checked for changes.
+            if job['fingerprint'] == o.get('fingerprint'):
+                return
+            if job['fingerprint'] is None:
+                # Stored before fingerprints were recorded: this is the baseline.
+                self.store.set_fingerprint(o)
+                return
+            previous = self.store.find(o)
+            logger.info("Changed: '%s'" % o['title'])
+
+        if not self.claim(o):
+            logger.debug("Already in progress: '%s'" % o['title'])
+            return
+
+        self.store.assign_id(o, previous)
+        if previous is not None:
+            # Kept in the request's state, so a resumed run still knows
+            # which torrent the rebuilt one supersedes.
+            o['replaces'] = previous.get('infohash')
+        self.store.transition(o, "discovered")
+        return self.download_request(o, previous)
+
+    def download_request(self, o, previous=None):
+        fpath = self.generate_request_path(o)
+        if previous is None:
+            hasher = StreamingPieceHasher(fpath, [m['filename'] for m in o['documents']])
+            self.download_documents(fpath, o['documents'], hasher)
+        else:
+            hasher = None
+            self.download_documents(fpath, self.update_documents(fpath, o, previous))
+        self.store.transition(o, "downloaded")
+        return {"request": o, "path": fpath, "hasher": hasher, "state": "downloaded"}
+
+    def update_documents(self, path, o, previous):
+        """Carries over documents that are unchanged since previous and
+        still on disk, removes those no longer listed, and returns the
+        ones that need downloading."""
+
+        old = dict((m['original_url'], m) for m in previous.get('documents', []))
+        filenames = set(m['filename'] for m in o['documents'])
+        pending = []
+        for meta in o['documents']:
+            prev = old.get(meta['original_url'])
+            fn = os.path.join(path, meta['filename'])
+            if prev is not None and prev['filename'] == meta['filename'] and \
+                    prev.get('sha256') is not None and os.path.exists(fn) and \
+                    os.path.getsize(fn) == prev.get('size'):
+                meta['size'] = prev['size']
+                meta['sha256'] = prev['sha256']
+            else:
+                pending.append(meta)
+
+        # The torrent is built from the directory, so withdrawn documents
+        # must go; their content is kept in the blob store.
+        for meta in previous.get('documents', []):
+            fn = os.path.join(path, meta['filename'])
+            if meta['filename'] not in filenames and os.path.exists(fn):
+                logger.info("Removing withdrawn document '%s'" % fn)
+                os.unlink(fn)
+
+        logger.info("'%s': %d of %d documents new or changed" % (
+            o['title'], len(pending), len(o['documents'])))
+        return pending
+
+    def fingerprint(self, node):
+        # Must be computed the same way as the stored fingerprint.
+        return fingerprint(node)
+
+    def changed(self, stored, node):
+        """Whether a known listing entry needs re-fetching: always false
+        unless fingerprinting is enabled."""
+        return self.config['fingerprint'] and stored != self.fingerprint(node)
+
+    def resume_request(self, state):
+        o = state['request']
+        logger.info("Resuming '%s' after '%s'" % (o['title'], state['state']))
+        if not reached(state['state'], "downloaded"):
+            previous = None
+            if 'replaces' in o:
+                # A changed request: db.requests still holds the old version.
+                previous = self.store.find(o)
+            return self.download_request(o, previous)
+        return {"request": o, "path": self.generate_request_path(o), "state": state['state']}
+
+    def torrent_request(self, job):
+        o = job['request']
+        if reached(job['state'], "torrented") and o.get('infohash') is not None and \
+                os.path.exists(self.torrents.path(o['infohash'])):
+            job['torrent_path'] = self.torrents.path(o['infohash'])
+            return job
+
         tname = o['title'] + '.torrent'
-        torrent_path = self.generate_torrent(fpath, tname)
-        if torrent_path is None:
-            logger.error("Torrent path is null! Skipping.")
+        try:
+            with self.metrics.timer("torrent_create"):
+                infohash = self.generate_torrent(job['path'], tname, job.get('hasher'))
+        except TorrentCreationError as e:
+            logger.error("Torrent creation failed for '%s': %s. Skipping." % (o['title'], e))
+            self.metrics.inc("torrent_failures", reason=e.reason)
             return
-        o['torrent'] = tname
+        self.metrics.inc("torrent_bytes", sum(m['size'] for m in o['documents']))
+        o['torrent'] = self.torrents.relative_path(infohash)
+        o['infohash'] = infohash
+        torrent_path = self.torrents.path(infohash)
         logger.info("Generated torrent: '%s'" % torrent_path)
+        self.store.transition(o, "torrented")
+
+        job['torrent_path'] = torrent_path
+        return job
 
+    def seed_request(self, job):
+        if reached(job['state'], "seeded"):
+            return job
         try:
-            self.seed_torrent(torrent_path, fpath)
+            self.seed_torrent(job['torrent_path'], job['path'])
         except FileNotFoundError as e:
             logger.warn(e)
+        self.store.transition(job['request'], "seeded")
+        return job
+
+    def persist_request(self, job):
+        o = job['request']
+        replaces = o.pop('replaces', None)
+        self.store.upsert(o)
+        self.store.replace("feed_entries", feeds.feed_entry(o, self.config['base_url']))
+        self.store.bump_generation(o['organisation'])
+        if replaces not in (None, o.get('infohash')):
+            # Only once no stored request refers to the old torrent.
+            self.store.flush()
+            self.retire_torrent(replaces)
+        return job
+
+    def index_request(self, job):
+        with self.metrics.timer("search_index"):
+            self.store.replace("search_index", search.index_entry(job['request'], job['path']))
+        self.store.transition(job['request'], "published")
+        return job
+
+    def request_stages(self):
+        return [
+            ("fetch", self.fetch_request),
+            ("torrent", self.torrent_request),
+            ("seed", self.seed_request),
+            ("persist", self.persist_request),
+            ("index", self.index_request)
+        ]
 
-        self.db.requests.insert(o)
-
+    def scrape_request(self, url, node=None):
+        job = {"url": url, "node": node}
+        try:
+            for name, func in self.request_stages():
+                job = func(job)
+                if job is None:
+                    return
+        finally:
+            self.store.flush()
+        return job['request']
+
+    def create_pipeline(self):
+        pipeline = Pipeline(self.config['queue_size'])
+        for name, func in self.request_stages():
+            pipeline.add_stage(name, self.profiled(func), self.config['stage_workers'].get(name, 1))
+        return pipeline.start()
 
     def scrape(self):
+        if self.config['profile_path'] is not None:
+            self.profiler = metrics.Profiler()
+        before = self.metrics.snapshot()
+        started = datetime.datetime.utcnow()
+        start = time.time()
+        try:
+            return self.profiled(self.run_scrape)()
+        finally:
+            self.write_summary(started, time.time() - start,
+                               metrics.delta(before, self.metrics.snapshot()))
+            if self.profiler is not None:
+                logger.info("Writing profile to '%s'" % self.config['profile_path'])
+                self.profiler.dump(self.config['profile_path'])
+                # One-shot: a long-running scheduler only profiles one scrape.
+                self.profiler = None
+                self.config['profile_path'] = None
+
+    def run_scrape(self):
         logging.info("Getting start page...")
-        page = self.get_start_page()
+        with self.metrics.timer("start_page"):
+            page = self.get_start_page()
 
         logging.info("Finding new documents...")
-        new_docs = self.find_new_documents(page)
+        with self.metrics.timer("find_new_documents"):
+            new_docs = self.find_new_documents(page)
 
         logging.debug("New docs: %r" % new_docs)
 
-        total = len(new_docs)
-        for n, o in enumerate(new_docs):
-            logging.info("[%s/%s] Scraping: %s" % (n+1, total, o['title']))
-            self.scrape_request(o.get('url'), o.get('node'))
+        resumed = self.store.incomplete()
+        with self.in_flight_lock:
+            self.in_flight = set(x['key'] for x in resumed)
+        if len(resumed) > 0:
+            logging.info("Resuming %d unfinished requests" % len(resumed))
 
+        self.pipeline_stats = {}
+        pipeline = self.create_pipeline()
+        total = len(new_docs)
+        try:
+            for state in resumed:
+                pipeline.put({"resume": state})
+            for n, o in enumerate(new_docs):
+                logging.info("[%s/%s] Scraping: %s" % (n+1, total, o['title']))
+                job = {"url": o.get('url'), "node": o.get('node')}
+                if 'fingerprint' in o:
+                    job['fingerprint'] = o['fingerprint']
+                pipeline.put(job)
+        finally:
+            pipeline.join()
+            self.store.flush()
+            self.cache.save()
+            self.pipeline_stats = pipeline.stats()
+
+        for name, stats in self.pipeline_stats.items():
+            logging.info("Stage '%s': %d processed, %d skipped, %d failed, %.2f/s" % (
+                name, stats['processed'], stats['dropped'], stats['failed'],
+                stats['items_per_second']))
+
+        return self.pipeline_stats['persist']['processed']
+
+    def write_summary(self, started, duration, run):
+        elapsed = max(duration, 1e-6)
+        torrent_seconds = metrics.total(run, "torrent_create", 'sum')
+        self.run_summary = {
+            "organisation": self.ORGANISATION,
+            "started": started.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "duration": duration,
+            "stages": self.pipeline_stats,
+            "rates": {
+                "documents_per_second": metrics.total(run, "documents") / elapsed,
+                "download_mb_per_second": metrics.total(run, "document_bytes") / 1048576.0 / elapsed,
+                "hash_mb_per_second": metrics.total(run, "torrent_bytes") / 1048576.0 /
+                                     torrent_seconds if torrent_seconds > 0 else 0.0,
+                "db_queries": metrics.total(run, "db_query", 'count'),
+                "db_seconds": metrics.total(run, "db_query", 'sum')
+            },
+            "metrics": run
+        }
+        logger.info("%(documents_per_second).2f documents/s, %(download_mb_per_second).2f MB/s "
+                    "downloaded, %(hash_mb_per_second).1f MB/s hashed, %(db_queries)d DB queries "
+                    "in %(db_seconds).2fs" % self.run_summary['rates'])
 
-class AGDScraper(Scraper):
-    BASE_URL = "http://www.ag.gov.au"
+        if self.config['summary_path'] is None:
+            return
+        os.makedirs(self.config['summary_path'], exist_ok=True)
+        fn = os.path.join(self.config['summary_path'], "%s-%s.json" % (
+            self.ORGANISATION, started.strftime("%Y%m%dT%H%M%S")))
+        with open(fn, 'w') as f:
+            json.dump(self.run_summary, f, indent=2, sort_keys=True)
+
+
+class SpecScraper(Scraper):
+    """Scrapes a disclosure log described by a spec in departments.py;
+    subclasses come from for_spec."""
+
+    SPEC = None
+    EXTRACTOR = None
+    find_missing = True
+
+    @classmethod
+    def for_spec(cls, spec):
+        name = "%sScraper" % spec['organisation'].capitalize()
+        return type(name, (cls,), {
+            "ORGANISATION": spec['organisation'],
+            "SPEC": spec,
+            "EXTRACTOR": Extractor(spec)
+        })
+
+    def start_url(self):
+        listing = self.SPEC['listing']
+        if self.find_missing and 'start_all' in listing:
+            return listing['start_all']
+        return listing['start']
 
     def get_start_page(self):
-        url = "http://www.ag.gov.au/RightsAndProtections/FOI/Pages/Freedomofinformationdisclosurelog.aspx"
-        if self.find_missing:
-            url += "?lsf=date&lso=0"
-        return self.download_page(url)
+        return self.download_page(self.start_url())
 
-    def is_anchor_new(self, a):
-        x = self.db.requests.find_one({
-            "organisation": "agd",
-            "title": a.attrib['title'].strip()})
-        return x is None
+    def listing_pages(self, page):
+        """Yields (url, page) for each page of entries: the pages linked
+        from the start page, or the start page and those after it, with
+        the next one downloading while the current one is read."""
 
-    def find_new_documents(self, page):
-        selector = ".disclosure-log-list .dl-item-title a"
-        next_page_selector = ".paging-next a"
-        
-        urls = []
-        while True:
-            anchors = page.cssselect(selector)
-
-            for a in anchors:
-                if self.is_anchor_new(a):
-                    logging.debug("Adding URL: %s" % a.attrib['href'])
-                    urls.append({"url": a.attrib['href'], "title": a.text_content()})
-                elif self.find_missing:
-                    pass # stops the immediate ending
-                else:
-                    return urls
+        extractor = self.EXTRACTOR
+        urls = extractor.page_urls(page)
+        if urls is not None:
+            yield from zip(urls, self.download_pages(urls))
+            return
 
-            next_page = page.cssselect(next_page_selector)
-            if len(next_page) == 0:
+        url = self.start_url()
+        while True:
+            next_url = extractor.next_page(page)
+            pending = None if next_url is None else self.prefetch_page(next_url)
+            try:
+                yield url, page
+            except GeneratorExit:
+                if pending is not None:
+                    pending.cancel()
+                raise
+            if pending is None:
                 logging.debug("No next page. Done.")
-                return urls
-
-            page = self.download_page(next_page[0].attrib['href'])
+                return
+            url, page = next_url, pending.result()
             logging.debug("Next page downloaded.")
 
-    def parse_date_string(self, ds):
-        return datetime.datetime.strptime(ds, "%A, %d %B %Y")
-
-    def parse_agd_doc_url(self, url):
-        x = urllib.parse.urlparse(url)
-        if x.path.endswith("WordViewer.aspx"):
-            new_path = urllib.parse.parse_qs(x.query)['id'][0]
-            if new_path.startswith('/'):
-                return self.BASE_URL + new_path
-            else:
-                return new_path
+    def find_new_documents(self, page):
+        extractor = self.EXTRACTOR
+        listing = self.SPEC['listing']
+        stop_at_known = listing.get('newest_first', False) and not self.find_missing
 
-        return url
+        jobs = []
+        pages = self.listing_pages(page)
+        try:
+            for url, page in pages:
+                entries = extractor.entries(page)
+                keys = [extractor.key(x) for x in entries]
+                known = self.store.fingerprints(listing['key_field'], keys)
+
+                stop = False
+                for key, entry in zip(keys, entries):
+                    job = {"url": extractor.entry_url(url, entry), "title": extractor.title(entry)}
+                    if not extractor.detail:
+                        job['node'] = entry
+
+                    if key in known:
+                        if extractor.detail and self.config['fingerprint']:
+                            # The document list is only on the detail page,
+                            # so the entry is fetched (conditionally) and
+                            # compared there.
+                            job['fingerprint'] = known[key]
+                        elif not extractor.detail and self.changed(known[key], entry):
+                            job['fingerprint'] = known[key]
+                        else:
+                            job = None
+
+                        if stop_at_known:
+                            if not self.config['fingerprint']:
+                                return jobs
+                            stop = True # after checking the rest of this page
+
+                    if job is not None:
+                        logging.debug("Adding: %s" % job['title'])
+                        jobs.append(job)
+
+                if stop:
+                    break
+        finally:
+            pages.close()
+        return jobs
+
+    def fingerprint(self, node):
+        return self.EXTRACTOR.fingerprint(node)
 
     def generate_metadata(self, url, node):
-        sel_title = ".wc-title h1"
-        sel_release_date = ".dl-date .dl-value"
-        sel_description = ".dl-abstract .dl-value"
-        sel_document_urls = ".dl-downloads a"
-
-        o = {
-            "organisation": "agd",
-            "title": node.cssselect(sel_title)[0].text_content().strip(),
-            "description": node.cssselect(sel_description)[0].text_content().strip(),
-            "date_released": self.parse_date_string(
-                node.cssselect(sel_release_date)[0].text_content().strip()),
-            "date_retrieved": datetime.datetime.utcnow(),
-            "original_url": url,
-            "documents": []
-        }
-
-        for a in node.cssselect(sel_document_urls):
-            if a.attrib.get('href') is None:
-                logger.error("Invalid anchor: '%s'" % lxml.html.tostring(a).decode())
-                return
-
-            if a.attrib['href'].startswith("mailto"):
-                logger.error("Invalid anchor: '%s'" % lxml.html.tostring(a).decode())
-                return
-
-            parsed_url = self.parse_agd_doc_url(self.BASE_URL + a.attrib['href'])
-
-            meta = {
-                "original_url": parsed_url,
-                "title": a.text_content().strip()
-            }
-
-            fname = urllib.parse.unquote(meta['original_url'].rsplit('/', 1)[-1])
-            meta['filename'] = fname
-
-            o['documents'].append(meta)
-
-        return o
+        return self.EXTRACTOR.metadata(url, node)
 
     def scrape(self, find_missing=True):
         self.find_missing = find_missing
-        super().scrape()
-
-
-class DFATScraper(Scraper):
-    def get_start_page(self):
-        return self.download_page("http://www.dfat.gov.au/foi/disclosure-log.html")
-
-    def parse_date_string(self, ds):
-        return datetime.datetime.strptime(ds, "%d %B %Y")
-
-    def find_new_documents(self, page):
-        selector = "#requests tbody tr"
-
-        rows = page.cssselect(selector)
-        new_rows = []
-
-        for row in rows:
-            if len(row.cssselect('td')) != 5:
-                continue
-
-            foi_ref = row[0].text_content().strip()
-            if self.db.requests.find_one({"title": foi_ref}) is not None:
-                continue
-
-            new_rows.append({
-                "url": "http://www.dfat.gov.au/foi/disclosure-log.html",
-                "node": row,
-                "title": foi_ref
-            })
-
-        return new_rows
-
-    def generate_metadata(self, url, node):
-        foi_ref = node[0].text_content().strip()
-
-        o = {
-            "organisation": "dfat",
-            "title": foi_ref,
-            "reference": foi_ref,
-            "description": lxml.html.tostring(node[2]).decode().strip(),
-            "date_released": self.parse_date_string(node[1].text_content().strip()),
-            "date_retrieved": datetime.datetime.utcnow(),
-            "original_url": url,
-            "documents": []
-        }
-
-        anchors = node[3].cssselect('a')
-
-        for a in anchors:
-            if a.attrib.get('href') is None:
-                logger.error("Invalid anchor: '%s'" % lxml.html.tostring(a).decode())
-                return
-
-            if a.attrib['href'].startswith("mailto"):
-                logger.error("Invalid anchor: '%s'" % lxml.html.tostring(a).decode())
-                return
-
-            parsed_url = "http://www.dfat.gov.au" + a.attrib['href']
-
-            meta = {
-                "original_url": parsed_url,
-                "title": a.text_content().strip()
-            }
-
-            fname = urllib.parse.unquote(meta['original_url'].rsplit('/', 1)[-1])
-            meta['filename'] = fname
-
-            o['documents'].append(meta)
-
-        return o
-
-
-class DefenceScraper(Scraper):
-    DIR = "/foi"
-    HOST = "http://www.defence.gov.au"
-
-    def get_start_page(self):
-        return self.download_page("http://www.defence.gov.au/foi/disclosure_log.htm")
-
-    def find_new_documents(self, page):
-        selector = ".homeBtn a"
-        table = "#table tbody tr"
-
-        new_docs = []
-        for a in page.cssselect(selector):
-            url = self.parse_document_url(a.attrib['href'])
-            subpage = self.download_page(url)
-
-            for tr in subpage.cssselect(table):
-                foi_ref = tr[1].text_content().strip()
-
-                if self.db.requests.find_one({"reference": foi_ref}) is not None:
-                    continue
-
-                new_docs.append({"url": url, "node": tr, "title": tr.cssselect(".foiTitle")[0].text_content()})
-
-        return new_docs
-
-    def parse_date_string(self, ds):
-        last_ex = None
-        for df in ["%d-%b-%y", "%d-%B-%y", "%d-%b-%Y", "%d-%B-%Y"]:
-            try:
-                return datetime.datetime.strptime(ds, df)
-            except Exception as e:
-                last_ex = e
-        raise last_ex
-
-    def parse_document_url(self, url):
-        if url.startswith("http"):
-            return url
-        elif url.startswith('/'):
-            return self.HOST + url
-        return self.HOST + self.DIR + "/" + url
-
-    def generate_metadata(self, url, node):
-        foi_ref = node[1].text_content().strip()
-
-        o = {
-            "organisation": "defence",
-            "title": node.cssselect(".foiTitle")[0].text_content().strip(),
-            "reference": foi_ref,
-            "access": node[3].text_content().strip(),
-            "exemptions": node[4].text_content().strip(),
-            "date_released": self.parse_date_string(node[0].text_content().split(' ')[0].strip()),
-            "date_retrieved": datetime.datetime.utcnow(),
-            "original_url": url,
-            "documents": []
-        }
-
-        anchors = node[2].cssselect('a')
-
-        for a in anchors:
-            if a.attrib.get('href') is None:
-                logger.error("Invalid anchor: '%s'" % lxml.html.tostring(a).decode())
-                return
-
-            if a.attrib['href'].startswith("mailto"):
-                logger.error("Invalid anchor: '%s'" % lxml.html.tostring(a).decode())
-                return
-
-            parsed_url = self.parse_document_url(a.attrib['href'])
-
-            meta = {
-                "original_url": parsed_url,
-                "title": a.text_content().strip()
-            }
-
-            fname = urllib.parse.unquote(meta['original_url'].rsplit('/', 1)[-1])
-            meta['filename'] = fname
-
-            o['documents'].append(meta)
-
-        return o
+        return super().scrape()
 
 
+scrapers = dict((spec['organisation'], SpecScraper.for_spec(spec))
+                for spec in departments.SPECS)
 
+AGDScraper = scrapers['agd']
+DFATScraper = scrapers['dfat']
+DefenceScraper = scrapers['defence']
 
-scrapers = {
-    "agd": AGDScraper,
-    "dfat": DFATScraper,
-    "defence": DefenceScraper
-}
 
 if __name__ == "__main__":
-    #TODO add argparse
-    import sys
-    x = scrapers[sys.argv[1]]()
-    x.scrape()
+    import argparse
+    parser = argparse.ArgumentParser(description="Scrape FOI disclosure logs once.")
+    parser.add_argument('departments', nargs='+', choices=sorted(scrapers.keys()))
+    parser.add_argument('--profile', default=None, metavar='FILE',
+                        help="write cProfile stats for the scrape to FILE (per department: "
+                             "FILE.<department>)")
+    parser.add_argument('--fingerprint', action='store_true',
+                        help="also re-fetch known entries whose listing or document list changed")
+    args = parser.parse_args()
+
+    for dept in args.departments:
+        x = scrapers[dept]()
+        x.config['fingerprint'] = args.fingerprint
+        if args.profile is not None:
+            x.config['profile_path'] = args.profile if len(args.departments) == 1 \
+                                       else "%s.%s" % (args.profile, dept)
+        x.scrape()
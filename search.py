@@ -0,0 +1,145 @@
+"""
+This file is part of foitorrent.
+Copyright (c) 2013  Brendan Molloy
+
+foitorrent is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+foitorrent is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with foitorrent.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import logging
+import os.path
+import re
+import shutil
+import subprocess
+import zipfile
+
+import pymongo
+
+logger = logging.getLogger()
+
+# Cap on text taken from a single document, so one enormous release can't
+# bloat its index entry.
+MAX_DOCUMENT_TEXT = 1024 * 1024
+
+STOPWORDS = frozenset("""a an and are as at be by for from has in is it its of on or
+that the this to was were will with""".split())
+
+TOKEN = re.compile(r"\w+", re.UNICODE)
+TAG = re.compile(r"<[^>]+>")
+
+
+def tokenize(text):
+    return [t for t in TOKEN.findall(TAG.sub(" ", text).lower())
+            if len(t) > 1 and t not in STOPWORDS]
+
+
+def _run(args):
+    try:
+        out = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                             timeout=120).stdout
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.warning("Text extraction failed for %r: %s" % (args, e))
+        return ""
+    return out[:MAX_DOCUMENT_TEXT].decode('utf-8', 'replace')
+
+
+def extract_text(fn):
+    """Best-effort plain text of a downloaded document. PDFs and .doc files
+    need pdftotext and antiword on the PATH; without them only titles and
+    descriptions are indexed."""
+
+    ext = os.path.splitext(fn)[1].lower()
+    if ext == '.pdf' and shutil.which('pdftotext'):
+        return _run(['pdftotext', '-q', '-enc', 'UTF-8', fn, '-'])
+    if ext == '.doc' and shutil.which('antiword'):
+        return _run(['antiword', fn])
+    if ext == '.docx':
+        try:
+            with zipfile.ZipFile(fn) as z:
+                xml = z.read('word/document.xml')[:MAX_DOCUMENT_TEXT * 4]
+            return TAG.sub(" ", xml.decode('utf-8', 'replace'))
+        except (OSError, KeyError, zipfile.BadZipFile):
+            return ""
+    if ext in ('.txt', '.csv'):
+        with open(fn, 'rb') as f:
+            return f.read(MAX_DOCUMENT_TEXT).decode('utf-8', 'replace')
+    return ""
+
+
+def create_indexes(db):
+    db.search_index.create_index([("terms", pymongo.ASCENDING),
+                                  ("date_released", pymongo.DESCENDING)])
+    db.search_index.create_index([("organisation", pymongo.ASCENDING),
+                                  ("terms", pymongo.ASCENDING)])
+
+
+def index_entry(o, path=None):
+    """o's entry in the inverted index: one document per request holding
+    its distinct terms, with a multikey index on them."""
+
+    parts = [o['title'], o.get('description', ''), o.get('reference', '')]
+    for meta in o.get('documents', []):
+        parts.append(meta.get('title', ''))
+        if path is not None:
+            fn = os.path.join(path, meta['filename'])
+            if os.path.exists(fn):
+                parts.append(extract_text(fn))
+
+    return {
+        "_id": o['_id'],
+        "organisation": o['organisation'],
+        "date_released": o['date_released'],
+        "terms": sorted(set(tokenize(" ".join(parts))))
+    }
+
+
+def index_request(db, o, path=None):
+    entry = index_entry(o, path)
+    db.search_index.replace_one({"_id": o['_id']}, entry, upsert=True)
+    return len(entry['terms'])
+
+
+def search(db, text, organisation=None, limit=50):
+    terms = sorted(set(tokenize(text)))
+    if len(terms) == 0:
+        return []
+
+    query = {"terms": {"$all": terms}}
+    if organisation is not None:
+        query['organisation'] = organisation
+
+    hits = [x['_id'] for x in db.search_index.find(query, {"_id": 1})
+            .sort("date_released", pymongo.DESCENDING).limit(limit)]
+    reqs = dict((x['_id'], x) for x in db.requests.find(
+        {"_id": {"$in": hits}}, {"title": 1, "organisation": 1, "date_released": 1}))
+    return [reqs[h] for h in hits if h in reqs]
+
+
+if __name__ == "__main__":
+    import argparse
+    from .scraper import Scraper
+
+    parser = argparse.ArgumentParser(description="Rebuild the search index from stored requests.")
+    parser.add_argument('--organisation', default=None)
+    parser.add_argument('--no-documents', action='store_true',
+                        help="index titles and descriptions only")
+    args = parser.parse_args()
+
+    scraper = Scraper()
+    query = {} if args.organisation is None else {"organisation": args.organisation}
+    count = 0
+    for o in scraper.db.requests.find(query):
+        path = None if args.no_documents else scraper.generate_request_path(o)
+        index_request(scraper.db, o, path)
+        count += 1
+    logger.info("Indexed %d requests" % count)
@@ -0,0 +1,216 @@
+"""
+This file is part of foitorrent.
+Copyright (c) 2013  Brendan Molloy
+
+foitorrent is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+foitorrent is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with foitorrent.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import errno
+import hashlib
+import logging
+import os
+import os.path
+import re
+import threading
+
+from .torrents import bencode, bdecode
+
+logger = logging.getLogger()
+
+
+def infohash(data):
+    return hashlib.sha1(bencode(bdecode(data)['info'])).hexdigest()
+
+
+class TorrentStore:
+    """Stores .torrent files by info hash, sharded two levels deep by hash
+    prefix: <root>/ab/cd/abcd....torrent"""
+
+    LAYOUT = re.compile(r'^[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{40}\.torrent$')
+
+    def __init__(self, root):
+        self.root = root
+
+    def relative_path(self, infohash):
+        return "%s/%s/%s.torrent" % (infohash[:2], infohash[2:4], infohash)
+
+    def path(self, infohash):
+        return os.path.join(self.root, *self.relative_path(infohash).split('/'))
+
+    def is_stored(self, relative_path):
+        return self.LAYOUT.match(relative_path) is not None
+
+    def put(self, data):
+        h = infohash(data)
+        fn = self.path(h)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        tmp = fn + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, fn)
+        return h
+
+    def remove(self, infohash):
+        fn = self.path(infohash)
+        if os.path.exists(fn):
+            os.unlink(fn)
+
+    def add_file(self, fn):
+        with open(fn, 'rb') as f:
+            h = infohash(f.read())
+        dest = self.path(h)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.replace(fn, dest)
+        return h
+
+    def migrate(self, db, legacy_name):
+        """Moves flat torrents/<name>.torrent files into the sharded layout
+        and records each request's info hash. legacy_name maps a request's
+        stored 'torrent' value to its old file name."""
+
+        moved = 0
+        missing = 0
+        for o in db.requests.find({"torrent": {"$exists": True}},
+                                  {"torrent": 1, "infohash": 1}):
+            if self.is_stored(o['torrent']):
+                continue
+
+            fn = os.path.join(self.root, legacy_name(o['torrent']))
+            if not os.path.exists(fn):
+                logger.warning("Missing torrent for %s: '%s'" % (o['_id'], fn))
+                missing += 1
+                continue
+
+            h = self.add_file(fn)
+            db.requests.update_one({"_id": o['_id']}, {"$set": {
+                "torrent": self.relative_path(h),
+                "infohash": h
+            }})
+            moved += 1
+
+        logger.info("Migrated %d torrents, %d missing" % (moved, missing))
+        return moved, missing
+
+
+class BlobStore:
+    """Content-addressed copies of downloaded documents, keyed by sha256 and
+    sharded like TorrentStore. Request directories hold hardlinks into it,
+    so a document republished under several requests is stored once. The
+    store must be on the same filesystem as the request directories;
+    otherwise linking is disabled and every copy is kept."""
+
+    def __init__(self, root):
+        self.root = root
+        self.enabled = True
+        self.lock = threading.Lock()
+
+    def path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256)
+
+    def has(self, sha256, size=None):
+        try:
+            st = os.stat(self.path(sha256))
+        except FileNotFoundError:
+            return False
+        return size is None or st.st_size == size
+
+    def _replace_with_link(self, src, dest):
+        tmp = os.path.join(os.path.dirname(dest), '.%s.link' % os.path.basename(dest))
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        os.link(src, tmp)
+        os.replace(tmp, dest)
+
+    def link(self, fn, sha256):
+        """Puts fn into the store, or if its content is already there,
+        replaces fn with a hardlink to the stored copy. Returns True when
+        a duplicate was collapsed."""
+
+        if not self.enabled:
+            return False
+
+        blob = self.path(sha256)
+        try:
+            with self.lock:
+                if os.path.exists(blob):
+                    if os.path.samefile(blob, fn):
+                        return False
+                    self._replace_with_link(blob, fn)
+                    return True
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                try:
+                    os.link(fn, blob)
+                except FileExistsError:
+                    # Stored since the check by another process, which the
+                    # lock doesn't cover.
+                    if os.path.samefile(blob, fn):
+                        return False
+                    self._replace_with_link(blob, fn)
+                    return True
+                return False
+        except OSError as e:
+            if e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                logger.warning("Disabling document deduplication: %s" % e)
+                self.enabled = False
+                return False
+            raise
+
+    def restore(self, sha256, dest):
+        self._replace_with_link(self.path(sha256), dest)
+
+    def report(self):
+        blobs = 0
+        links = 0
+        stored = 0
+        saved = 0
+        for root, dirs, files in os.walk(self.root):
+            for fn in files:
+                st = os.stat(os.path.join(root, fn))
+                copies = st.st_nlink - 1
+                blobs += 1
+                links += copies
+                stored += st.st_size
+                saved += max(copies - 1, 0) * st.st_size
+        return {"blobs": blobs, "links": links, "stored_bytes": stored, "saved_bytes": saved}
+
+
+if __name__ == "__main__":
+    import argparse
+    from .scraper import Scraper
+
+    parser = argparse.ArgumentParser(description="Maintain the torrent and document stores.")
+    parser.add_argument('command', choices=['migrate', 'dedup', 'report'],
+                        help="migrate: move flat .torrent files into the sharded store; "
+                             "dedup: hardlink existing request documents into the blob store; "
+                             "report: show how much disk deduplication saves")
+    args = parser.parse_args()
+
+    scraper = Scraper()
+    if args.command == 'migrate':
+        scraper.torrents.migrate(scraper.db, scraper.sanitise_torrent_name)
+    elif args.command == 'dedup':
+        collapsed = 0
+        for o in scraper.db.requests.find({}, {"documents": 1, "organisation": 1,
+                                                "date_released": 1, "title": 1}):
+            path = scraper.generate_request_path(o)
+            for meta in o['documents']:
+                fn = os.path.join(path, meta['filename'])
+                if meta.get('sha256') is not None and os.path.exists(fn) and \
+                        os.path.getsize(fn) == meta.get('size'):
+                    collapsed += scraper.blobs.link(fn, meta['sha256'])
+        logger.info("Collapsed %d duplicate documents" % collapsed)
+    else:
+        r = scraper.blobs.report()
+        logger.info("%d blobs, %d request copies, %.1f MB stored, %.1f MB saved by deduplication" % (
+            r['blobs'], r['links'], r['stored_bytes'] / 1048576.0, r['saved_bytes'] / 1048576.0))
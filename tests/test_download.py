@@ -0,0 +1,208 @@
+"""
+This file is part of foitorrent.
+Copyright (c) 2013  Brendan Molloy
+
+foitorrent is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+foitorrent is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with foitorrent.  If not, see <http://www.gnu.org/licenses/>.
+
+Scraper.download_document against a local stand-in server. Needs
+mongomock for the Scraper's database. Run from the directory above the
+package:
+
+    python -m unittest foitorrent.tests.test_download
+"""
+
+import hashlib
+import http.server
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import unittest
+
+import requests
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+from ..httpcache import HTTPCache
+from ..scraper import Scraper
+from ..storage import BlobStore
+
+DOCUMENT = os.urandom(200000)
+ETAG = '"%s"' % hashlib.md5(DOCUMENT).hexdigest()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """Serves DOCUMENT at /doc.pdf with an ETag, honouring If-None-Match
+    and Range/If-Range like a real server. With server.truncate set, the
+    next response stops after that many bytes and drops the connection."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.log.append((self.path, dict(self.headers)))
+        if self.path == '/busy.pdf':
+            return self.respond(503, b"busy")
+        if self.headers.get('If-None-Match') == ETAG:
+            self.send_response(304)
+            self.send_header('ETag', ETAG)
+            self.end_headers()
+            return
+
+        rng = self.headers.get('Range')
+        if rng is not None and self.headers.get('If-Range') == ETAG:
+            start = int(rng[len('bytes='):].rstrip('-'))
+            if start >= len(DOCUMENT):
+                return self.respond(416, b"")
+            return self.respond(206, DOCUMENT[start:], {
+                'Content-Range': 'bytes %d-%d/%d' % (start, len(DOCUMENT) - 1, len(DOCUMENT))})
+        self.respond(200, DOCUMENT)
+
+    def respond(self, status, body, headers={}):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', ETAG)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        if self.server.truncate is not None:
+            body = body[:self.server.truncate]
+            self.server.truncate = None
+            self.close_connection = True
+        self.wfile.write(body)
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not installed")
+class DownloadDocumentTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        cls.server.daemon_threads = True
+        cls.server.log = []
+        cls.server.truncate = None
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base = 'http://127.0.0.1:%d' % cls.server.server_port
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.server.log[:] = []
+        self.server.truncate = None
+        self.path = os.path.join(self.tmp, 'request')
+        os.makedirs(self.path)
+        self.scraper = self.create_scraper()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def create_scraper(self):
+        return Scraper(db=mongomock.MongoClient().foitorrent,
+                       cache=HTTPCache(os.path.join(self.tmp, 'cache'), 1024 * 1024),
+                       blobs=BlobStore(os.path.join(self.tmp, 'blobs')))
+
+    def meta(self, name='doc.pdf'):
+        return {"original_url": self.base + '/' + name, "filename": name}
+
+    def document(self):
+        with open(os.path.join(self.path, 'doc.pdf'), 'rb') as f:
+            return f.read()
+
+    def part(self):
+        return os.path.join(self.path, '.doc.pdf.part')
+
+    def counter(self, name, **labels):
+        for x in self.scraper.metrics.snapshot()['counters']:
+            if x['name'] == name and x['labels'] == labels:
+                return x['value']
+        return 0
+
+    def test_download(self):
+        meta = self.meta()
+        self.scraper.download_document(self.path, meta)
+        self.assertEqual(self.document(), DOCUMENT)
+        self.assertEqual(meta['size'], len(DOCUMENT))
+        self.assertEqual(meta['sha256'], hashlib.sha256(DOCUMENT).hexdigest())
+        entry = self.scraper.cache.get(meta['original_url'])
+        self.assertEqual((entry['etag'], entry['sha256']), (ETAG, meta['sha256']))
+        self.assertTrue(self.scraper.blobs.has(meta['sha256'], len(DOCUMENT)))
+
+    def test_not_modified(self):
+        self.scraper.download_document(self.path, self.meta())
+        meta = self.meta()
+        self.scraper.download_document(self.path, meta)
+        self.assertEqual(self.server.log[-1][1].get('If-None-Match'), ETAG)
+        self.assertEqual(meta['sha256'], hashlib.sha256(DOCUMENT).hexdigest())
+        self.assertEqual(self.counter("documents", status="not_modified"), 1)
+
+    def test_not_modified_restores_blob(self):
+        self.scraper.download_document(self.path, self.meta())
+        os.unlink(os.path.join(self.path, 'doc.pdf'))
+        meta = self.meta()
+        self.scraper.download_document(self.path, meta)
+        self.assertEqual(self.server.log[-1][1].get('If-None-Match'), ETAG)
+        self.assertEqual(self.document(), DOCUMENT)
+        self.assertEqual(meta['size'], len(DOCUMENT))
+
+    def test_resume_after_interruption(self):
+        self.server.truncate = 150000
+        with self.assertRaises(requests.RequestException):
+            self.scraper.download_document(self.path, self.meta())
+        # Only whole chunks reach the .part.
+        offset = os.path.getsize(self.part())
+        self.assertTrue(0 < offset < 150000)
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'doc.pdf')))
+
+        meta = self.meta()
+        self.scraper.download_document(self.path, meta)
+        headers = self.server.log[-1][1]
+        self.assertEqual((headers.get('Range'), headers.get('If-Range')),
+                         ('bytes=%d-' % offset, ETAG))
+        self.assertEqual(self.document(), DOCUMENT)
+        self.assertEqual(meta['sha256'], hashlib.sha256(DOCUMENT).hexdigest())
+        self.assertFalse(os.path.exists(self.part()))
+        self.assertEqual(self.counter("documents", status="resumed"), 1)
+        self.assertEqual(self.counter("document_bytes"), len(DOCUMENT) - offset)
+
+    def test_complete_part_restarts(self):
+        self.scraper.cache.put(self.meta()['original_url'], {'ETag': ETAG})
+        with open(self.part(), 'wb') as f:
+            f.write(DOCUMENT)
+
+        meta = self.meta()
+        self.scraper.download_document(self.path, meta)
+        self.assertEqual(len(self.server.log), 2)
+        self.assertIsNotNone(self.server.log[0][1].get('Range'))
+        self.assertIsNone(self.server.log[1][1].get('Range'))
+        self.assertEqual(self.document(), DOCUMENT)
+        self.assertEqual(meta['size'], len(DOCUMENT))
+
+    def test_error_status(self):
+        meta = self.meta('busy.pdf')
+        with self.assertRaises(requests.HTTPError):
+            self.scraper.download_document(self.path, meta)
+        self.assertEqual(os.listdir(self.path), [])
+        self.assertNotIn('sha256', meta)
+        self.assertIsNone(self.scraper.cache.get(meta['original_url']))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+"""
+This file is part of foitorrent.
+Copyright (c) 2013  Brendan Molloy
+
+foitorrent is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+foitorrent is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with foitorrent.  If not, see <http://www.gnu.org/licenses/>.
+
+Run from the directory above the package:
+
+    python -m unittest foitorrent.tests.test_httpcache
+"""
+
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from ..httpcache import HTTPCache
+
+URL = "http://example.com/foi/log"
+HEADERS = {"ETag": '"abc"', "Last-Modified": "Mon, 02 Sep 2013 00:00:00 GMT"}
+
+
+class HTTPCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_conditional_headers(self):
+        cache = HTTPCache(self.path, 1024)
+        cache.put(URL, HEADERS, size=10)
+        entry = cache.get(URL)
+        self.assertEqual(cache.conditional_headers(entry), {
+            "If-None-Match": '"abc"',
+            "If-Modified-Since": "Mon, 02 Sep 2013 00:00:00 GMT"})
+        self.assertEqual(cache.validator(entry), '"abc"')
+        self.assertEqual(entry['size'], 10)
+
+    def test_no_validators_forgets_url(self):
+        cache = HTTPCache(self.path, 1024)
+        cache.put(URL, HEADERS)
+        cache.put(URL, {})
+        self.assertIsNone(cache.get(URL))
+
+    def test_body_round_trip(self):
+        cache = HTTPCache(self.path, 1024)
+        cache.store_body(URL, HEADERS, b"<html></html>", encoding="utf-8")
+        self.assertEqual(cache.read_body(URL), b"<html></html>")
+        self.assertEqual(cache.get(URL)['encoding'], "utf-8")
+
+    def test_missing_body_is_dropped(self):
+        cache = HTTPCache(self.path, 1024)
+        cache.store_body(URL, HEADERS, b"<html></html>")
+        os.unlink(cache.body_path(URL))
+        self.assertIsNone(cache.read_body(URL))
+        self.assertIsNone(cache.get(URL))
+
+    def test_evicts_least_recently_used(self):
+        cache = HTTPCache(self.path, 25)
+        cache.store_body(URL + "1", HEADERS, b"x" * 10)
+        cache.store_body(URL + "2", HEADERS, b"x" * 10)
+        cache.get(URL + "1")
+        cache.store_body(URL + "3", HEADERS, b"x" * 10)
+        self.assertIsNone(cache.get(URL + "2"))
+        self.assertFalse(os.path.exists(cache.body_path(URL + "2")))
+        self.assertEqual(cache.read_body(URL + "1"), b"x" * 10)
+        self.assertEqual(cache.size, 20)
+
+    def test_save_and_reload(self):
+        cache = HTTPCache(self.path, 1024)
+        cache.store_body(URL, HEADERS, b"body")
+        cache.put(URL + ".pdf", HEADERS, size=4, sha256="00")
+        cache.save()
+
+        cache = HTTPCache(self.path, 1024)
+        self.assertEqual(cache.read_body(URL), b"body")
+        self.assertEqual(cache.get(URL + ".pdf")['sha256'], "00")
+        self.assertEqual(cache.size, 4)
+
+    def test_save_max_age(self):
+        cache = HTTPCache(self.path, 1024)
+        cache.put(URL, HEADERS)
+        cache.save()
+        cache.put(URL + ".pdf", HEADERS)
+        cache.save(60)
+        self.assertIsNone(HTTPCache(self.path, 1024).get(URL + ".pdf"))
+        cache.save()
+        self.assertIsNotNone(HTTPCache(self.path, 1024).get(URL + ".pdf"))
+
+
+if __name__ == "__main__":
+    unittest.main()
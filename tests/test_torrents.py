@@ -0,0 +1,124 @@
+"""
+This file is part of foitorrent.
+Copyright (c) 2013  Brendan Molloy
+
+foitorrent is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+foitorrent is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with foitorrent.  If not, see <http://www.gnu.org/licenses/>.
+
+Run from the directory above the package:
+
+    python -m unittest foitorrent.tests.test_torrents
+"""
+
+import hashlib
+import os
+import os.path
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from ..torrents import TorrentBuilder, bencode, bdecode
+
+TRACKERS = ["udp://tracker.publicbt.com:80/announce",
+            "udp://tracker.openbittorrent.com:80/announce"]
+COMMENT = "Torrent retrieved from foitorrent: http://foitorrent.brendan.so"
+CREATION_DATE = 1380000000
+
+BIG = b"foitorrent\n" * 3000    # 33000 bytes: two 32 KiB pieces with A.txt
+SMALL = b"a\n"
+
+
+def expected_torrent():
+    """The .torrent transmission-create 2.82 writes for the fixture tree,
+    spelled out key by key rather than produced by bencode()."""
+
+    data = SMALL + BIG
+    pieces = hashlib.sha1(data[:32768]).digest() + hashlib.sha1(data[32768:]).digest()
+    return (
+        b"d"
+        b"8:announce" b"38:" + TRACKERS[0].encode() +
+        b"13:announce-list"
+        b"l" b"l" b"38:" + TRACKERS[0].encode() + b"e"
+             b"l" b"44:" + TRACKERS[1].encode() + b"e" b"e"
+        b"7:comment" b"63:" + COMMENT.encode() +
+        b"10:created by" b"25:Transmission/2.82 (14160)"
+        b"13:creation date" b"i1380000000e"
+        b"8:encoding" b"5:UTF-8"
+        b"4:info" b"d"
+            b"5:files" b"l"
+                b"d" b"6:length" b"i2e" b"4:path" b"l" b"5:A.txt" b"e" b"e"
+                b"d" b"6:length" b"i33000e" b"4:path" b"l" b"3:sub" b"5:b.txt" b"e" b"e"
+            b"e"
+            b"4:name" b"7:fixture"
+            b"12:piece length" b"i32768e"
+            b"6:pieces" b"40:" + pieces +
+            b"7:private" b"i0e"
+        b"e"
+        b"e")
+
+
+class TorrentBuilderTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "fixture")
+        os.makedirs(os.path.join(self.path, "sub"))
+        files = {"A.txt": SMALL, os.path.join("sub", "b.txt"): BIG,
+                 ".hidden": b"skipped", "empty": b""}
+        for fn, data in files.items():
+            with open(os.path.join(self.path, fn), 'wb') as f:
+                f.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def builder(self, **kwargs):
+        return TorrentBuilder(self.path, TRACKERS, COMMENT, **kwargs)
+
+    def test_matches_transmission_create_layout(self):
+        data = self.builder(creation_date=CREATION_DATE).build()
+        self.assertEqual(data, expected_torrent())
+
+    def test_bdecode_round_trip(self):
+        data = self.builder(creation_date=CREATION_DATE).build()
+        meta = bdecode(data)
+        self.assertEqual(bencode(meta), data)
+        self.assertEqual(meta['creation date'], CREATION_DATE)
+        self.assertEqual([x['path'] for x in meta['info']['files']],
+                         [[b"A.txt"], [b"sub", b"b.txt"]])
+
+    def test_parallel_pieces_match(self):
+        builder = self.builder(processes=2)
+        builder.PARALLEL_THRESHOLD = 0
+        self.assertEqual(builder.hash_pieces(), self.builder().hash_pieces())
+
+    @unittest.skipIf(shutil.which("transmission-create") is None,
+                     "transmission-create is not installed")
+    def test_matches_transmission_create(self):
+        out = os.path.join(self.tmp, "out.torrent")
+        args = ["transmission-create", "-o", out, "-c", COMMENT]
+        for tracker in TRACKERS:
+            args += ["-t", tracker]
+        subprocess.check_call(args + [self.path], stdout=subprocess.DEVNULL)
+        with open(out, 'rb') as f:
+            recorded = f.read()
+
+        # Only the creation date and version string can't be pinned.
+        meta = bdecode(recorded)
+        builder = self.builder(created_by=meta['created by'].decode('utf-8'),
+                               creation_date=meta['creation date'])
+        self.assertEqual(builder.build(), recorded)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -16,7 +16,400 @@ You should have received a copy of the GNU General Public License
 along with foitorrent.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from subprocess import Popen, PIPE
+import concurrent.futures
+import hashlib
+import logging
+import mmap
+import os
+import os.path
+import threading
+import time
+
+from . import metrics
+
+logger = logging.getLogger()
+
+CREATED_BY = "Transmission/2.82 (14160)"
+
+
+class TorrentCreationError(Exception):
+    """Why a torrent couldn't be built; reason is a short label for
+    counting failures, the message has the details."""
+
+    def __init__(self, message, reason="error"):
+        Exception.__init__(self, message)
+        self.reason = reason
+
+
+def bencode(obj):
+    if isinstance(obj, int):
+        return b"i" + str(obj).encode() + b"e"
+    if isinstance(obj, str):
+        obj = obj.encode('utf-8')
+    if isinstance(obj, bytes):
+        return str(len(obj)).encode() + b":" + obj
+    if isinstance(obj, (list, tuple)):
+        return b"l" + b"".join(bencode(x) for x in obj) + b"e"
+    if isinstance(obj, dict):
+        items = sorted((k.encode('utf-8') if isinstance(k, str) else k, v)
+                       for k, v in obj.items())
+        return b"d" + b"".join(bencode(k) + bencode(v) for k, v in items) + b"e"
+    raise TypeError("Cannot bencode %r" % type(obj))
+
+
+def bdecode(data):
+    def decode(i):
+        c = data[i:i+1]
+        if c == b"i":
+            end = data.index(b"e", i)
+            return int(data[i+1:end]), end + 1
+        if c == b"l":
+            i += 1
+            out = []
+            while data[i:i+1] != b"e":
+                x, i = decode(i)
+                out.append(x)
+            return out, i + 1
+        if c == b"d":
+            i += 1
+            out = {}
+            while data[i:i+1] != b"e":
+                k, i = decode(i)
+                v, i = decode(i)
+                out[k.decode('utf-8')] = v
+            return out, i + 1
+        if c.isdigit():
+            colon = data.index(b":", i)
+            end = colon + 1 + int(data[i:colon])
+            return data[colon+1:end], end
+        raise ValueError("Invalid bencoded data at offset %d" % i)
+
+    obj, end = decode(0)
+    if end != len(data):
+        raise ValueError("Trailing data after offset %d" % end)
+    return obj
+
+
+def best_piece_size(total_size):
+    # Same thresholds as transmission-create's bestPieceSize().
+    KiB = 1024
+    MiB = 1024 * KiB
+    GiB = 1024 * MiB
+
+    if total_size >= 2 * GiB:
+        return 2 * MiB
+    if total_size >= 1 * GiB:
+        return 1 * MiB
+    if total_size >= 512 * MiB:
+        return 512 * KiB
+    if total_size >= 350 * MiB:
+        return 256 * KiB
+    if total_size >= 150 * MiB:
+        return 128 * KiB
+    if total_size >= 50 * MiB:
+        return 64 * KiB
+    return 32 * KiB
+
+
+def list_torrent_files(path):
+    """Returns (filename, path components, size) for every file that
+    transmission-create would include under path, in the same order:
+    dotfiles and empty files are skipped and files are sorted by path,
+    ignoring ASCII case."""
+
+    if not os.path.isdir(path):
+        if os.path.getsize(path) == 0:
+            return []
+        return [(path, [], os.path.getsize(path))]
+
+    files = []
+    for root, dirs, fnames in os.walk(path):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for fn in fnames:
+            if fn.startswith('.'):
+                continue
+            full = os.path.join(root, fn)
+            if not os.path.isfile(full):
+                continue
+            size = os.path.getsize(full)
+            if size == 0:
+                continue
+            components = os.path.relpath(full, path).split(os.sep)
+            files.append((full, components, size))
+
+    files.sort(key=lambda x: x[0].encode('utf-8').lower())
+    return files
+
+
+def _hash_piece_range(files, piece_size, total_size, start, end):
+    # files is a list of (filename, offset in the concatenated stream, size).
+    pieces = []
+    maps = {}
+    try:
+        for piece in range(start, end):
+            lo = piece * piece_size
+            hi = min(lo + piece_size, total_size)
+            m = hashlib.sha1()
+            for fn, offset, size in files:
+                if offset >= hi or offset + size <= lo:
+                    continue
+                if fn not in maps:
+                    with open(fn, 'rb') as f:
+                        maps[fn] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                m.update(maps[fn][max(lo - offset, 0):min(hi - offset, size)])
+            pieces.append(m.digest())
+    finally:
+        for x in maps.values():
+            x.close()
+    return b"".join(pieces)
+
+
+def hash_pieces_parallel(files, piece_size, processes=None, task_size=64 * 1024 * 1024):
+    """Hashes the concatenation of files (filename, size) into SHA-1 pieces,
+    splitting it into piece-aligned ranges of about task_size bytes that
+    are hashed from memory-mapped files in a process pool."""
+
+    layout = []
+    offset = 0
+    for fn, size in files:
+        layout.append((fn, offset, size))
+        offset += size
+    total_size = offset
+    count = (total_size + piece_size - 1) // piece_size
+    step = max(1, task_size // piece_size)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = []
+        for start in range(0, count, step):
+            end = min(start + step, count)
+            lo = start * piece_size
+            hi = end * piece_size
+            task_files = [x for x in layout if x[1] < hi and x[1] + x[2] > lo]
+            futures.append(pool.submit(_hash_piece_range, task_files, piece_size,
+                                       total_size, start, end))
+        return b"".join(f.result() for f in futures)
+
+
+class PieceHasher:
+    def __init__(self, piece_size):
+        self.piece_size = piece_size
+        self.pieces = []
+        self.piece = hashlib.sha1()
+        self.filled = 0
+        self.length = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        self.length += len(view)
+        while len(view) > 0:
+            n = min(len(view), self.piece_size - self.filled)
+            self.piece.update(view[:n])
+            self.filled += n
+            view = view[n:]
+            if self.filled == self.piece_size:
+                self.pieces.append(self.piece.digest())
+                self.piece = hashlib.sha1()
+                self.filled = 0
+
+    def digest(self):
+        if self.filled > 0:
+            return b"".join(self.pieces) + self.piece.digest()
+        return b"".join(self.pieces)
+
+
+class StreamingPieceHasher:
+    """Computes a request directory's piece hashes while its documents are
+    being downloaded, so the .torrent can be written without reading the
+    files back.
+
+    Downloads report each chunk after it has been written to disk. Bytes
+    are hashed live for the file at the head of the torrent's file order;
+    files that finish ahead of their turn, or that started before every
+    size was known, are caught up from disk when they reach the head."""
+
+    def __init__(self, directory, filenames):
+        self.directory = directory
+        self.filenames = list(filenames)
+        self.lock = threading.Lock()
+        self.sizes = [None] * len(self.filenames)
+        self.paths = [None] * len(self.filenames)
+        self.fed = [0] * len(self.filenames)
+        self.done = [False] * len(self.filenames)
+        self.failed = len(set(self.filenames)) != len(self.filenames)
+        self.order = None
+        self.head = 0
+        self.hasher = None
+
+    def set_size(self, index, size):
+        with self.lock:
+            self.sizes[index] = size
+            self._start()
+
+    def wrote(self, index, path, offset, data):
+        with self.lock:
+            self.paths[index] = path
+            if self.order is None or self.head >= len(self.order) or \
+                    self.order[self.head] != index:
+                return
+            if self.fed[index] < offset:
+                self._catch_up(index)
+            if offset <= self.fed[index] < offset + len(data):
+                self.hasher.update(memoryview(data)[self.fed[index] - offset:])
+                self.fed[index] = offset + len(data)
+
+    def finish(self, index, path, size):
+        with self.lock:
+            self.paths[index] = path
+            self.done[index] = True
+            if self.order is None:
+                self.sizes[index] = size
+                self._start()
+            else:
+                self._advance()
+
+    def fail(self, index):
+        with self.lock:
+            self.failed = True
+
+    def pieces(self, builder):
+        with self.lock:
+            if self.failed or self.order is None or self.head < len(self.order):
+                return None
+            expected = [([self.filenames[i]], self.fed[i]) for i in self.order]
+            actual = [(components, size) for fn, components, size in builder.files]
+            if expected != actual or builder.piece_size != self.hasher.piece_size:
+                return None
+            return self.hasher.digest()
+
+    def _start(self):
+        if self.order is not None or None in self.sizes:
+            return
+        order = [i for i in range(len(self.filenames)) if self.sizes[i] > 0]
+        order.sort(key=lambda i: os.path.join(
+            self.directory, self.filenames[i]).encode('utf-8').lower())
+        self.order = order
+        self.hasher = PieceHasher(best_piece_size(sum(self.sizes)))
+        self._advance()
+
+    def _advance(self):
+        while self.head < len(self.order):
+            index = self.order[self.head]
+            self._catch_up(index)
+            if not self.done[index]:
+                return
+            self.head += 1
+
+    def _catch_up(self, index):
+        if self.paths[index] is None:
+            return
+        try:
+            with open(self.paths[index], 'rb') as f:
+                f.seek(self.fed[index])
+                while True:
+                    data = f.read(1024 * 1024)
+                    if not data:
+                        break
+                    self.hasher.update(data)
+                    self.fed[index] += len(data)
+        except FileNotFoundError:
+            # Renamed into place meanwhile; finish() will catch up from
+            # the final path.
+            pass
+
+
+class TorrentBuilder:
+    # Below this size a process pool costs more than it saves.
+    PARALLEL_THRESHOLD = 64 * 1024 * 1024
+
+    def __init__(self, path, trackers=[], comment=None, private=False,
+                 created_by=CREATED_BY, creation_date=None, processes=1):
+        self.path = path
+        self.processes = processes
+        self.trackers = list(trackers)
+        self.comment = comment
+        self.private = private
+        self.created_by = created_by
+        self.creation_date = creation_date
+
+        try:
+            self.files = list_torrent_files(path)
+        except OSError as e:
+            raise TorrentCreationError("Cannot read '%s': %s" % (path, e), "unreadable")
+        if len(self.files) == 0:
+            raise TorrentCreationError("No files found in '%s'" % path, "empty")
+
+        self.total_size = sum(size for fn, components, size in self.files)
+        self.piece_size = best_piece_size(self.total_size)
+
+    def hash_pieces(self):
+        if self.processes != 1 and self.total_size >= self.PARALLEL_THRESHOLD:
+            return hash_pieces_parallel([(fn, size) for fn, components, size in self.files],
+                                        self.piece_size, self.processes)
+
+        pieces = []
+        piece = hashlib.sha1()
+        filled = 0
+
+        for fn, components, size in self.files:
+            with open(fn, 'rb') as f:
+                while True:
+                    data = f.read(self.piece_size - filled)
+                    if not data:
+                        break
+                    piece.update(data)
+                    filled += len(data)
+                    if filled == self.piece_size:
+                        pieces.append(piece.digest())
+                        piece = hashlib.sha1()
+                        filled = 0
+
+        if filled > 0:
+            pieces.append(piece.digest())
+        return b"".join(pieces)
+
+    def info(self, pieces):
+        info = {
+            "name": os.path.basename(os.path.abspath(self.path)),
+            "piece length": self.piece_size,
+            "pieces": pieces,
+            "private": 1 if self.private else 0
+        }
+        if os.path.isdir(self.path):
+            info['files'] = [{"length": size, "path": components}
+                             for fn, components, size in self.files]
+        else:
+            info['length'] = self.total_size
+        return info
+
+    def metainfo(self, pieces):
+        meta = {
+            "created by": self.created_by,
+            "creation date": self.creation_date if self.creation_date is not None
+                             else int(time.time()),
+            "encoding": "UTF-8",
+            "info": self.info(pieces)
+        }
+        if len(self.trackers) > 0:
+            meta['announce'] = self.trackers[0]
+        if len(self.trackers) > 1:
+            meta['announce-list'] = [[tracker] for tracker in self.trackers]
+        if self.comment:
+            meta['comment'] = self.comment
+        return meta
+
+    def build(self, pieces=None):
+        if pieces is None:
+            pieces = self.hash_pieces()
+        return bencode(self.metainfo(pieces))
+
+    def write(self, outfile, pieces=None):
+        data = self.build(pieces)
+        tmp = outfile + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, outfile)
+        return outfile
+
 
 class Torrent:
     def __init__(self, torrent):
@@ -47,18 +440,44 @@ class BitTorrentClient:
     def __init__(self):
         pass
 
-    def create_torrent(self, outfile, path, trackers=[], comment=None, private=False):
-        raise NotImplementedError
+    def create_torrent(self, outfile, path, trackers=[], comment=None, private=False,
+                       hasher=None, processes=1):
+        """Writes the .torrent for path to outfile and returns outfile;
+        raises TorrentCreationError if it can't be built."""
+
+        try:
+            builder = TorrentBuilder(path, trackers, comment, private, processes=processes)
+            pieces = None
+            if hasher is not None:
+                pieces = hasher.pieces(builder)
+                if pieces is None:
+                    logger.debug("Streamed piece hashes unusable for '%s'; rehashing" % path)
+            if pieces is None:
+                with metrics.registry.timer("piece_hashing"):
+                    pieces = builder.hash_pieces()
+                metrics.registry.inc("piece_hashing_bytes", builder.total_size)
+            return builder.write(outfile, pieces)
+        except OSError as e:
+            raise TorrentCreationError("Cannot hash or write '%s': %s" % (path, e), "io")
 
     def add_torrent(self, path, target):
         raise NotImplementedError
 
+    def add_torrents(self, items):
+        return [self.add_torrent(path, target) for path, target in items]
+
     def remove_torrent(self, torrent):
         raise NotImplementedError
 
+    def set_trackers(self, torrent, trackers):
+        raise NotImplementedError
+
     def get_torrent(self, id):
         raise NotImplementedError
 
+    def get_torrents(self, ids, fields=None):
+        return [self.get_torrent(id) for id in ids]
+
     def clear_all_torrents(self):
         raise NotImplementedError
 
@@ -73,17 +492,25 @@ class TransmissionTorrent(Torrent):
     def status(self):
         return self.torrent.status
 
+    def _tracker_total(self, field):
+        # The torrent-level seeders/leechers/timesCompleted fields were
+        # dropped after RPC version 7; each tracker now reports its own,
+        # with -1 for unknown.
+        return sum(max(x[field], 0) for x in self.torrent.trackerStats)
+
     def seeders(self):
-        return self.torrent.seeders
+        return self._tracker_total('seederCount')
 
     def leechers(self):
-        return self.torrent.leechers
+        return self._tracker_total('leecherCount')
 
     def downloads(self):
-        return self.torrent.timesCompleted
+        return self._tracker_total('downloadCount')
 
 
 class TransmissionClient(BitTorrentClient):
+    STATUS_FIELDS = ['id', 'hashString', 'name', 'status', 'trackerStats']
+
     def __init__(self):
         import transmissionrpc
         self.client = transmissionrpc.Client()
@@ -96,30 +523,94 @@ class TransmissionClient(BitTorrentClient):
         for k, v in dct.items():
             return v
 
-    def create_torrent(self, outfile, path, trackers=[], comment=None, private=False):
-        args = ['transmission-create', '-o', outfile]
-        for tracker in trackers:
-            args += ['-t', tracker]
-        if comment is not None:
-            args += ['-c', comment]
-        if private is True:
-            args.append('-p')
-        args.append(path)
-        out = Popen(args, stdout=PIPE, stderr=PIPE).communicate()[0].decode().strip()
-        if not out.endswith("done!"):
-            return None
-        return outfile
-
     def add_torrent(self, path, target):
-        torrent = self._get_torrent(self.client.add_torrent(path, download_dir=target))
+        with metrics.registry.timer("transmission_call", method="add_torrent"):
+            torrent = self._get_torrent(self.client.add_torrent(path, download_dir=target))
         return TransmissionTorrent(torrent)
 
+    def add_torrents(self, items):
+        # The RPC protocol has no multi-add, but every call here reuses the
+        # same client and session id instead of renegotiating per torrent.
+        out = []
+        for path, target in items:
+            try:
+                out.append(self.add_torrent(path, target))
+            except Exception as e:
+                logger.warning("Could not add '%s': %s" % (path, e))
+                out.append(None)
+        return out
+
     def remove_torrent(self, torrent):
-        self.client.remove_torrent(torrent.hash)
+        # Takes a Torrent or an info hash; the data is left in place.
+        with metrics.registry.timer("transmission_call", method="remove_torrent"):
+            self.client.remove_torrent(torrent if isinstance(torrent, str) else torrent.hash())
+
+    def set_trackers(self, torrent, trackers):
+        # Trackers live outside the info dict, so a torrent that only gained
+        # new ones keeps its hash and adding it again is a duplicate.
+        infohash = torrent if isinstance(torrent, str) else torrent.hash()
+        with metrics.registry.timer("transmission_call", method="set_trackers"):
+            current = self.client.get_torrents([infohash], arguments=['id', 'trackers'])[0].trackers
+            args = {}
+            remove = [x['id'] for x in current if x['announce'] not in trackers]
+            if len(remove) > 0:
+                args['trackerRemove'] = remove
+            announces = set(x['announce'] for x in current)
+            add = [x for x in trackers if x not in announces]
+            if len(add) > 0:
+                args['trackerAdd'] = add
+            if len(args) > 0:
+                self.client.change_torrent(infohash, **args)
 
     def get_torrent(self, id):
-        torrent = self._get_torrent(self.client.get_torrent(id))
+        with metrics.registry.timer("transmission_call", method="get_torrent"):
+            torrent = self._get_torrent(self.client.get_torrent(id))
         return TransmissionTorrent(torrent)
 
+    def get_torrents(self, ids, fields=None):
+        if len(ids) == 0:
+            return []
+        with metrics.registry.timer("transmission_call", method="get_torrents"):
+            torrents = self.client.get_torrents(list(ids), arguments=fields or self.STATUS_FIELDS)
+        return [TransmissionTorrent(t) for t in torrents]
+
     def clear_all_torrents(self):
-        self.client.remove_torrent([x.id for x in self.client.get_torrents()])
+        self.client.remove_torrent([x.id for x in self.client.get_torrents(arguments=['id'])])
+
+
+class SwarmCache:
+    """Caches seeders/leechers/downloads per info hash for ttl seconds;
+    misses are fetched together in a single get_torrents call."""
+
+    def __init__(self, client, ttl=60):
+        self.client = client
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, hashes):
+        now = time.time()
+        out = {}
+        missing = []
+        with self.lock:
+            for h in hashes:
+                entry = self.entries.get(h)
+                if entry is not None and entry[0] > now:
+                    out[h] = entry[1]
+                else:
+                    missing.append(h)
+
+        if len(missing) > 0:
+            fetched = {}
+            for t in self.client.get_torrents(missing):
+                fetched[t.hash()] = {
+                    "seeders": t.seeders(),
+                    "leechers": t.leechers(),
+                    "downloads": t.downloads()
+                }
+            with self.lock:
+                for h in missing:
+                    self.entries[h] = (now + self.ttl, fetched.get(h))
+            for h in missing:
+                out[h] = fetched.get(h)
+        return out
@@ -17,16 +17,39 @@ along with foitorrent.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import tornado.web
+import tornado.escape
 import tornado.ioloop
 import tornado.options
 import pymongo
+import bson.errors
 import bson.objectid
 import bson.json_util
+import re
+import urllib.parse
+import collections
+import datetime
+import hashlib
+import threading
+import time
+import concurrent.futures
+import itertools
+import logging
 
+from tornado import gen
+
+from . import feeds
+from . import metrics
+from . import search
+from .torrents import SwarmCache, TransmissionClient
 from tornado.web import RequestHandler, StaticFileHandler
 from tornado.options import define, options
 
 define('port', default=8888)
+define('db_workers', default=16, help="threads (and pooled connections) for database queries")
+define('swarm_ttl', default=60,
+       help="seconds to cache seeder/leecher counts from Transmission (0 to not show them)")
+
+logger = logging.getLogger()
 
 
 homepage = """<!DOCTYPE html><html><head><meta charset='utf-8'>
@@ -70,7 +93,48 @@ pre {{
 </body>
 </html>"""
 
-db = pymongo.Connection().foitorrent
+# Set up in __main__, once --db_workers has been parsed.
+db = None
+db_executor = None
+
+def run_db(func, *args, **kwargs):
+    """Runs a blocking pymongo call on the database thread pool and
+    returns a future, so handlers can yield it without stalling the
+    IOLoop."""
+    def timed():
+        with metrics.registry.timer("db_query", op=func.__name__):
+            return func(*args, **kwargs)
+    return db_executor.submit(timed)
+
+# Set up in __main__ when Transmission is reachable.
+swarm = None
+
+def swarm_stats(hashes):
+    """A future of {infohash: {"seeders", "leechers", "downloads"} or None},
+    served from the SwarmCache so a page of requests costs at most one
+    batched client call; empty when swarm stats are off."""
+    def fetch():
+        try:
+            return swarm.get(hashes)
+        except Exception as e:
+            logger.warning("Could not get swarm stats: %s" % e)
+            return {}
+    hashes = [h for h in hashes if h is not None]
+    if swarm is None or len(hashes) == 0:
+        future = concurrent.futures.Future()
+        future.set_result({})
+        return future
+    return db_executor.submit(fetch)
+
+def swarm_label(stats):
+    if stats is None:
+        return ""
+    return " (%(seeders)d seeders, %(leechers)d leechers, %(downloads)d downloads)" % stats
+
+def swarm_period():
+    # Swarm stats change without the generation moving, so pages showing
+    # them are only reusable for one cache period.
+    return 0 if swarm is None else int(time.time() // swarm.ttl)
 
 class HomePageHandler(RequestHandler):
     def get(self):
@@ -79,37 +143,312 @@ class HomePageHandler(RequestHandler):
 <li><a href="/d/agd">Attorney-General's Department</a></li>
 <li><a href="/d/dfat">Department of Foreign Affairs and Trade</a></li>
 <li><a href="/d/defence">Department of Defence</a></li>
-</ul>"""))
+</ul>
+<p><a href="/search">Search the archive</a> &middot; <a href="/feeds/all.atom">Atom feed of new torrents</a></p>"""))
+
+def generation(org):
+    # Bumped by the scraper whenever it stores a request for org.
+    x = db.generations.find_one({"_id": org})
+    return 0 if x is None else x['n']
+
+
+class PageCache:
+    def __init__(self, size=256):
+        self.size = size
+        self.lock = threading.Lock()
+        self.pages = collections.OrderedDict()
+
+    def get(self, key, gen):
+        with self.lock:
+            x = self.pages.get(key)
+            if x is None or x[0] != gen:
+                return None
+            self.pages.move_to_end(key)
+            return x[1]
+
+    def put(self, key, gen, page):
+        with self.lock:
+            self.pages[key] = (gen, page)
+            self.pages.move_to_end(key)
+            while len(self.pages) > self.size:
+                self.pages.popitem(last=False)
+
+dept_cache = PageCache()
+
 
 class DeptHandler(RequestHandler):
-    def get(self, org):
-        reqs = db.requests.find({"organisation": org})
+    PAGE_SIZE = 100
+
+    def parse_cursor(self, cursor):
+        ms, oid = cursor.split('-', 1)
+        return (datetime.datetime.utcfromtimestamp(int(ms) / 1000.0),
+                bson.objectid.ObjectId(oid))
+
+    def make_cursor(self, req):
+        delta = req['date_released'] - datetime.datetime(1970, 1, 1)
+        return "%d-%s" % (delta // datetime.timedelta(milliseconds=1), req['_id'])
+
+    def load_page(self, org, cursor):
+        query = {"organisation": org}
+        if cursor is not None:
+            date, oid = self.parse_cursor(cursor)
+            query['$or'] = [
+                {"date_released": {"$lt": date}},
+                {"date_released": date, "_id": {"$lt": oid}}
+            ]
+
+        reqs = list(db.requests.find(query, {"title": 1, "date_released": 1, "infohash": 1})
+                    .sort([("date_released", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)])
+                    .limit(self.PAGE_SIZE + 1))
+        older = None
+        if len(reqs) > self.PAGE_SIZE:
+            older = self.make_cursor(reqs[self.PAGE_SIZE - 1])
+        return reqs[:self.PAGE_SIZE], older
+
+    def render_page(self, org, reqs, older, stats):
         urls = []
         for req in reqs:
-            urls.append("<li><a href='/r/%s'>%s</a></li>" % (str(req['_id']), req['title']))
-        self.write(homepage.format(heading=org, content="<ul>%s</ul>" % "\n".join(urls)))
+            urls.append("<li><a href='/r/%s'>%s</a>%s</li>" % (
+                str(req['_id']), req['title'], swarm_label(stats.get(req.get('infohash')))))
+        content = "<p><a href='/feeds/%s.atom'>Atom feed</a></p><ul>%s</ul>" % (
+            org, "\n".join(urls))
+        if older is not None:
+            content += "<p><a href='/d/%s?before=%s'>Older requests</a></p>" % (org, older)
+        return homepage.format(heading=org, content=content)
+
+    @gen.coroutine
+    def get(self, org):
+        cursor = self.get_argument('before', None)
+        n = yield run_db(generation, org)
+
+        version = (n, swarm_period())
+        etag = '"%s"' % hashlib.sha1(("%s|%s|%s|%s" % ((org, cursor) + version)).encode()).hexdigest()
+        self.set_header("Etag", etag)
+        if self.request.headers.get("If-None-Match") == etag:
+            self.set_status(304)
+            return
+
+        key = (org, cursor)
+        page = dept_cache.get(key, version)
+        if page is None:
+            reqs = dept_cache.get(key + ("requests",), n)
+            if reqs is None:
+                try:
+                    reqs = yield run_db(self.load_page, org, cursor)
+                except (ValueError, bson.errors.InvalidId):
+                    raise tornado.web.HTTPError(400)
+                dept_cache.put(key + ("requests",), n, reqs)
+            stats = yield swarm_stats([x.get('infohash') for x in reqs[0]])
+            page = self.render_page(org, reqs[0], reqs[1], stats)
+            dept_cache.put(key, version, page)
+        self.write(page)
 
 class ReqHandler(RequestHandler):
+    @gen.coroutine
     def get(self, req):
-        req = db.requests.find_one({"_id": bson.objectid.ObjectId(req)})
+        req = yield run_db(db.requests.find_one, {"_id": bson.objectid.ObjectId(req)})
         if req is None:
             self.write("No req found.")
             return
 
+        stats = yield swarm_stats([req.get('infohash')])
         self.write(homepage.format(heading=req['title'], content="""
-        <p><a href="/t/{torrent}">Download Torrent</a></p>
+        <p><a href="/t/{id}">Download Torrent</a>{swarm}</p>
 
         <pre>{json_data}</pre>
-        """.format(torrent=req['torrent'], json_data=bson.json_util.dumps(req, indent=2))))
+        """.format(id=str(req['_id']), swarm=swarm_label(stats.get(req.get('infohash'))),
+                   json_data=bson.json_util.dumps(req, indent=2))))
+
+class APIRequestsHandler(RequestHandler):
+    """Streams matching requests as newline-delimited JSON, one
+    bson.json_util document per line, flushing each batch so memory stays
+    flat however large the result is."""
+
+    BATCH_SIZE = 500
+
+    def parse_date(self, name):
+        value = self.get_argument(name, None)
+        if value is None:
+            return None
+        try:
+            return datetime.datetime.strptime(value, "%Y-%m-%d")
+        except ValueError:
+            raise tornado.web.HTTPError(400, "%s must be YYYY-MM-DD" % name)
+
+    def build_query(self, org):
+        query = {}
+        if org is not None:
+            query['organisation'] = org
+        date_from = self.parse_date('from')
+        date_to = self.parse_date('to')
+        if date_from is not None or date_to is not None:
+            query['date_released'] = {}
+            if date_from is not None:
+                query['date_released']['$gte'] = date_from
+            if date_to is not None:
+                query['date_released']['$lt'] = date_to + datetime.timedelta(days=1)
+        return query
+
+    def next_batch(self, cursor):
+        return list(itertools.islice(cursor, self.BATCH_SIZE))
+
+    @gen.coroutine
+    def get(self):
+        yield self.stream(self.build_query(self.get_argument('organisation', None)))
+
+    @gen.coroutine
+    def stream(self, query):
+        self.set_header("Content-Type", "application/x-ndjson; charset=UTF-8")
+        cursor = db.requests.find(query).sort([("date_released", pymongo.ASCENDING),
+                                               ("_id", pymongo.ASCENDING)])
+        cursor.batch_size(self.BATCH_SIZE)
+        try:
+            while True:
+                batch = yield run_db(self.next_batch, cursor)
+                if len(batch) == 0:
+                    break
+                self.write("".join(bson.json_util.dumps(x) + "\n" for x in batch))
+                yield self.flush()
+        finally:
+            cursor.close()
+
+class APIDumpHandler(APIRequestsHandler):
+    @gen.coroutine
+    def get(self, org):
+        self.set_header("Content-Disposition", "attachment; filename=%s.ndjson" % org)
+        yield self.stream(self.build_query(org))
+
+class SearchHandler(RequestHandler):
+    @gen.coroutine
+    def get(self):
+        q = self.get_argument('q', '')
+        org = self.get_argument('organisation', None)
+        form = """<form action="/search"><input name="q" value=%s>
+<button type="submit">Search</button></form>""" % tornado.escape.xhtml_escape(q).join('""')
+
+        if q.strip() == '':
+            self.write(homepage.format(heading="Search", content=form))
+            return
+
+        start = time.time()
+        reqs = yield run_db(search.search, db, q, org)
+        urls = []
+        for req in reqs:
+            urls.append("<li><a href='/r/%s'>%s</a> (%s, %s)</li>" % (
+                str(req['_id']), req['title'], req['organisation'],
+                req['date_released'].strftime("%Y-%m-%d")))
+        self.write(homepage.format(heading="Search", content="%s<p>%d results in %.1fms</p><ul>%s</ul>" % (
+            form, len(reqs), (time.time() - start) * 1000, "\n".join(urls))))
+
+feed_cache = PageCache()
+
+class FeedHandler(RequestHandler):
+    """Atom feed of the newest requests: /feeds/all.atom or
+    /feeds/<org>.atom. Entries are rendered by the scraper when it stores
+    a request, so a feed is only reassembled when its generation moves."""
+
+    @gen.coroutine
+    def get(self, name):
+        org = None if name == "all" else name
+        key = "*" if org is None else org
+        n = yield run_db(generation, key)
+
+        etag = '"feed-%s-%s"' % (hashlib.sha1(key.encode()).hexdigest()[:12], n)
+        self.set_header("Etag", etag)
+        self.set_header("Content-Type", "application/atom+xml; charset=UTF-8")
+        if self.request.headers.get("If-None-Match") == etag:
+            self.set_status(304)
+            return
+
+        feed = feed_cache.get(key, n)
+        if feed is None:
+            self_link = "%s://%s%s" % (self.request.protocol, self.request.host,
+                                       self.request.path)
+            feed = yield run_db(feeds.render_feed, db, org, self_link)
+            feed_cache.put(key, n, feed)
+        self.write(feed)
+
+def latest_scrape_runs():
+    return list(db.scrape_runs.aggregate([
+        {"$sort": {"started": pymongo.DESCENDING}},
+        {"$group": {"_id": "$organisation", "run": {"$first": "$$ROOT"}}}
+    ]))
+
+
+def scrape_run_snapshot(run):
+    snapshot = run.get('metrics') or {"counters": [], "timers": []}
+    return {
+        "counters": snapshot['counters'] + [
+            {"name": "new_requests", "labels": {}, "value": run.get('new_requests') or 0},
+            {"name": "errors", "labels": {}, "value": 1 if 'error' in run else 0}],
+        "timers": snapshot['timers'] + [
+            {"name": "run", "labels": {}, "count": 1, "sum": run['duration'],
+             "max": run['duration']}]
+    }
+
+
+class MetricsHandler(RequestHandler):
+    """Prometheus text format: this process's own figures, plus the most
+    recent scrape of each department as recorded by the scheduler."""
+
+    @gen.coroutine
+    def get(self):
+        runs = yield run_db(latest_scrape_runs)
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.render([(metrics.registry.snapshot(), {})]))
+        self.write(metrics.render([(scrape_run_snapshot(x['run']), {"organisation": x['_id']})
+                                   for x in runs], prefix="foitorrent_last_scrape"))
+
+
+class Application(tornado.web.Application):
+    def log_request(self, handler):
+        metrics.registry.observe("http_request", handler.request.request_time(),
+                                 handler=type(handler).__name__)
+        metrics.registry.inc("http_responses", status=handler.get_status())
+        super().log_request(handler)
+
+
+class TorrentHandler(StaticFileHandler):
+    """Serves /t/<request id> from the info hash store, named after the
+    request's title. Any other path is served as a file under torrents/,
+    so old flat links keep working until they are migrated."""
+
+    @gen.coroutine
+    def get(self, path, include_body=True):
+        if re.match(r'^[0-9a-f]{24}$', path) is not None:
+            req = yield run_db(db.requests.find_one, {"_id": bson.objectid.ObjectId(path)},
+                               {"torrent": 1, "title": 1})
+            if req is None or 'torrent' not in req:
+                raise tornado.web.HTTPError(404)
+
+            self.set_header("Content-Disposition", "attachment; filename*=UTF-8''%s" %
+                            urllib.parse.quote(req['title'] + '.torrent'))
+            path = req['torrent']
+
+        result = super().get(path, include_body)
+        if result is not None:
+            yield result
 
 
 if __name__ == "__main__":
     tornado.options.parse_command_line()
-    application = tornado.web.Application([
+    db = pymongo.MongoClient(maxPoolSize=options.db_workers).foitorrent
+    db_executor = concurrent.futures.ThreadPoolExecutor(max_workers=options.db_workers)
+    if options.swarm_ttl > 0:
+        try:
+            swarm = SwarmCache(TransmissionClient(), options.swarm_ttl)
+        except Exception as e:
+            logger.warning("Not showing swarm stats: %s" % e)
+    application = Application([
         (r'/', HomePageHandler),
         (r'/d/(.*)', DeptHandler),
         (r'/r/(.*)', ReqHandler),
-        (r'/t/(.*)', StaticFileHandler, {"path": "torrents"})
+        (r'/t/(.*)', TorrentHandler, {"path": "torrents"}),
+        (r'/api/requests', APIRequestsHandler),
+        (r'/api/dump/([^/]+)', APIDumpHandler),
+        (r'/feeds/([^/]+)\.atom', FeedHandler),
+        (r'/search', SearchHandler),
+        (r'/metrics', MetricsHandler)
     ])
 
     application.listen(options.port, xheaders=True)